@@ -0,0 +1,50 @@
+import threading
+from collections import OrderedDict
+from hashlib import md5
+
+from django.core.cache import cache
+
+from recipes.models import Tag
+from recipes.versions import REFERENCE, get_version
+
+LOCAL_MAX_ENTRIES = 1024
+SHARED_TIMEOUT = 24 * 60 * 60
+
+_local = OrderedDict()
+_local_lock = threading.Lock()
+
+
+def get_reference(key, build):
+    """Возвращает справочные данные из двухуровневого кэша.
+
+    Первый уровень — память процесса, второй — общий кэш Django. Оба
+    привязаны к версии справочников: после её смены сигналами старые
+    записи больше не читаются, и значение собирается заново вызовом
+    build().
+    """
+    version = get_version(REFERENCE)
+    with _local_lock:
+        entry = _local.get(key)
+        if entry is not None and entry[0] == version:
+            _local.move_to_end(key)
+            return entry[1]
+    shared_key = 'reference:{}:{}'.format(
+        version, md5(key.encode()).hexdigest()
+    )
+    value = cache.get(shared_key)
+    if value is None:
+        value = build()
+        cache.set(shared_key, value, SHARED_TIMEOUT)
+    with _local_lock:
+        _local[key] = (version, value)
+        _local.move_to_end(key)
+        while len(_local) > LOCAL_MAX_ENTRIES:
+            _local.popitem(last=False)
+    return value
+
+
+def get_tags_by_id():
+    """Все теги по id для проверки входных данных без запросов."""
+    return get_reference(
+        'tags:by_id', lambda: {tag.id: tag for tag in Tag.objects.all()}
+    )
@@ -0,0 +1,19 @@
+from django.db import connections
+
+
+def check_connections(**kwargs):
+    """Закрывает сохранённые соединения с базой, которые перестали работать.
+
+    При CONN_MAX_AGE соединение переживает запрос, и после перезапуска
+    Postgres первый же запрос на нём упал бы. Перед запросом открытые
+    соединения проверяются SELECT 1 (как CONN_HEALTH_CHECKS в Django
+    4.1); это дешевле, чем заново подключаться к базе на каждый запрос.
+    """
+    for connection in connections.all():
+        if (
+            connection.connection is not None
+            and connection.settings_dict.get('CONN_HEALTH_CHECKS')
+            and not connection.in_atomic_block
+            and not connection.is_usable()
+        ):
+            connection.close()
@@ -0,0 +1,156 @@
+import csv
+import io
+import os
+import tempfile
+from abc import ABC, abstractmethod
+from pathlib import Path
+
+from django.conf import settings
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
+
+from recipes.models import ShoppingCartTotal
+
+PDF_FONT_NAME = 'ShoppingListFont'
+PDF_FONT_SIZE = 12
+PDF_MARGIN = 50
+
+
+class ShoppingListRenderer(ABC):
+    """Базовый формат файла со списком покупок."""
+
+    extension = None
+    content_type = None
+
+    @abstractmethod
+    def write(self, file, user, ingredients, today):
+        """Записывает список покупок в открытый двоичный файл."""
+
+
+class TextRenderer(ShoppingListRenderer):
+    extension = 'txt'
+    content_type = 'text/plain; charset=utf-8'
+
+    def write(self, file, user, ingredients, today):
+        file.write((
+            f'Список покупок для: {user.get_full_name()}\n\n'
+            f'Дата: {today:%d-%m-%Y}\n\n'
+        ).encode())
+        for ingredient in ingredients:
+            file.write((
+                f"- {ingredient['ingredient__name']} "
+                f"({ingredient['ingredient__measurement_unit']})"
+                f" - {ingredient['amount']}\n"
+            ).encode())
+        file.write(f'\nFoodgram ({today:%Y})'.encode())
+
+
+class CSVRenderer(ShoppingListRenderer):
+    extension = 'csv'
+    content_type = 'text/csv; charset=utf-8'
+
+    def write(self, file, user, ingredients, today):
+        text = io.TextIOWrapper(file, encoding='utf-8', newline='')
+        writer = csv.writer(text)
+        writer.writerow(('Ингредиент', 'Единица измерения', 'Количество'))
+        writer.writerows(
+            (
+                ingredient['ingredient__name'],
+                ingredient['ingredient__measurement_unit'],
+                ingredient['amount'],
+            )
+            for ingredient in ingredients
+        )
+        text.flush()
+        text.detach()
+
+
+class PDFRenderer(ShoppingListRenderer):
+    extension = 'pdf'
+    content_type = 'application/pdf'
+
+    def write(self, file, user, ingredients, today):
+        if PDF_FONT_NAME not in pdfmetrics.getRegisteredFontNames():
+            pdfmetrics.registerFont(
+                TTFont(PDF_FONT_NAME, settings.SHOPPING_LIST_PDF_FONT)
+            )
+        page = canvas.Canvas(file, pagesize=A4)
+        width, height = A4
+        line_height = PDF_FONT_SIZE * 1.5
+        y = height - PDF_MARGIN
+
+        def draw(line):
+            nonlocal y
+            if y < PDF_MARGIN:
+                page.showPage()
+                y = height - PDF_MARGIN
+            page.setFont(PDF_FONT_NAME, PDF_FONT_SIZE)
+            page.drawString(PDF_MARGIN, y, line)
+            y -= line_height
+
+        draw(f'Список покупок для: {user.get_full_name()}')
+        draw(f'Дата: {today:%d-%m-%Y}')
+        y -= line_height
+        for ingredient in ingredients:
+            draw(
+                f"- {ingredient['ingredient__name']} "
+                f"({ingredient['ingredient__measurement_unit']})"
+                f" - {ingredient['amount']}"
+            )
+        y -= line_height
+        draw(f'Foodgram ({today:%Y})')
+        page.save()
+
+
+SHOPPING_LIST_RENDERERS = {
+    renderer.extension: renderer()
+    for renderer in (TextRenderer, CSVRenderer, PDFRenderer)
+}
+
+
+def get_shopping_list_path(user, renderer, today):
+    """Путь к файлу списка покупок для текущей версии корзины."""
+    return (
+        Path(settings.MEDIA_ROOT)
+        / settings.SHOPPING_LIST_DIR
+        / str(user.id)
+        / f'{user.cart_version}-{today:%Y%m%d}.{renderer.extension}'
+    )
+
+
+def build_shopping_list(user, renderer, today):
+    """Возвращает путь к файлу списка покупок, собирая его при промахе.
+
+    Пока версия корзины пользователя не изменилась, повторная выгрузка
+    отдаёт готовый файл без запросов к базе. Файлы прошлых версий
+    удаляются. Для пустой корзины возвращает None.
+    """
+    path = get_shopping_list_path(user, renderer, today)
+    if path.exists():
+        return path
+    if not user.shopping_cart.exists():
+        return None
+    ingredients = ShoppingCartTotal.objects.filter(user=user).values(
+        'ingredient__name', 'ingredient__measurement_unit', 'amount'
+    ).order_by('ingredient__name')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temp_name = tempfile.mkstemp(
+        dir=path.parent, prefix=f'.{path.name}.'
+    )
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            renderer.write(file, user, ingredients.iterator(), today)
+        # mkstemp создаёт файл с правами 0600, а отдаёт его и nginx.
+        os.chmod(temp_name, settings.FILE_UPLOAD_PERMISSIONS or 0o644)
+        os.replace(temp_name, path)
+    except BaseException:
+        os.unlink(temp_name)
+        raise
+    # Временные файлы начинаются с точки: их дописывают другие воркеры.
+    prefix = path.name.rsplit('.', 1)[0] + '.'
+    for stale in path.parent.iterdir():
+        if not stale.name.startswith(('.', prefix)):
+            stale.unlink(missing_ok=True)
+    return path
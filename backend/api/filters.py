@@ -1,7 +1,7 @@
 from django.contrib.auth import get_user_model
 from django_filters.rest_framework import FilterSet, filters
 
-from recipes.models import Ingredient, Recipe, Tag
+from recipes.models import Ingredient, Recipe, Tag, fold_search_name
 
 User = get_user_model()
 
@@ -9,15 +9,15 @@ User = get_user_model()
 class IngredientFilter(FilterSet):
     """Фильтр ингредиентов по названию."""
 
-    name = filters.CharFilter(
-        field_name='name',
-        lookup_expr='istartswith'
-    )
+    name = filters.CharFilter(method='filter_name')
 
     class Meta:
         model = Ingredient
         fields = ('name', 'measurement_unit')
 
+    def filter_name(self, queryset, name, value):
+        return queryset.filter(search_name__contains=fold_search_name(value))
+
 
 class RecipeFilter(FilterSet):
     """Фильтр рецептов в списке покупок."""
@@ -27,11 +27,22 @@ class RecipeFilter(FilterSet):
         queryset=Tag.objects.all(),
     )
     author = filters.ModelChoiceFilter(queryset=User.objects.all())
+    # Объявлен до ordering: явная сортировка заменяет сортировку по рангу.
+    search = filters.CharFilter(method='filter_search')
+    ordering = filters.OrderingFilter(
+        fields=(
+            ('pub_date', 'pub_date'),
+            ('favorites_count', 'favorites_count'),
+        )
+    )
 
     class Meta:
         model = Recipe
         fields = ('tags', 'author')
 
+    def filter_search(self, queryset, name, value):
+        return queryset.search(value)
+
     def get_is_favorited(self, queryset, name, value):
         user = self.request.user
         if value and not user.is_anonymous:
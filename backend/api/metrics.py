@@ -0,0 +1,152 @@
+import asyncio
+import os
+import random
+import time
+from collections import Counter as SQLCounter
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.decorators import sync_and_async_middleware
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess
+)
+
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+UNRESOLVED = '<unresolved>'
+
+REQUESTS = Counter(
+    'foodgram_http_requests_total',
+    'Запросы по представлениям.',
+    ('view', 'method', 'status'),
+)
+LATENCY = Histogram(
+    'foodgram_http_request_duration_seconds',
+    'Время обработки запроса.',
+    ('view', 'method'),
+)
+SAMPLED = Counter(
+    'foodgram_sampled_requests_total',
+    'Запросы, для которых собирались метрики SQL.',
+    ('view',),
+)
+QUERIES = Histogram(
+    'foodgram_db_queries_per_request',
+    'Число SQL-запросов на один запрос.',
+    ('view',),
+    buckets=QUERY_BUCKETS,
+)
+QUERY_TIME = Counter(
+    'foodgram_db_query_duration_seconds_total',
+    'Суммарное время SQL-запросов.',
+    ('view',),
+)
+DUPLICATES = Counter(
+    'foodgram_db_duplicate_queries_total',
+    'Повторы одного и того же SQL в пределах запроса (N+1).',
+    ('view',),
+)
+
+# Статистика SQL текущего запроса; пуста, если запрос не попал в выборку.
+# Переменная контекста доходит и до потоков sync_to_async.
+current_stats = ContextVar('current_stats', default=None)
+
+
+class QueryStats:
+    __slots__ = ('count', 'duration', 'statements')
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = SQLCounter()
+
+    @property
+    def duplicates(self):
+        return self.count - len(self.statements)
+
+
+def record_query(execute, sql, params, many, context):
+    """Обёртка execute соединения: учитывает SQL запроса из выборки."""
+    stats = current_stats.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.duration += time.perf_counter() - started
+        stats.count += 1
+        stats.statements[sql] += 1
+
+
+def install_query_recorder(connection, **kwargs):
+    """Подключает record_query к каждому новому соединению с базой."""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def start_request():
+    stats = None
+    if random.random() < settings.METRICS_SAMPLE_RATE:
+        stats = QueryStats()
+    return time.perf_counter(), stats, current_stats.set(stats)
+
+
+def finish_request(request, response, started, stats, token):
+    current_stats.reset(token)
+    match = request.resolver_match
+    view = match.view_name if match is not None else UNRESOLVED
+    REQUESTS.labels(view, request.method, response.status_code).inc()
+    LATENCY.labels(view, request.method).observe(
+        time.perf_counter() - started
+    )
+    if stats is not None:
+        SAMPLED.labels(view).inc()
+        QUERIES.labels(view).observe(stats.count)
+        QUERY_TIME.labels(view).inc(stats.duration)
+        if stats.duplicates:
+            DUPLICATES.labels(view).inc(stats.duplicates)
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """Время ответа и SQL по представлениям для /metrics.
+
+    Время и число запросов считаются всегда, SQL — для доли запросов
+    METRICS_SAMPLE_RATE. Без изменения режима обработки: под ASGI
+    middleware асинхронное и не добавляет переходов между потоками.
+    """
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            started, stats, token = start_request()
+            response = await get_response(request)
+            finish_request(request, response, started, stats, token)
+            return response
+    else:
+        def middleware(request):
+            started, stats, token = start_request()
+            response = get_response(request)
+            finish_request(request, response, started, stats, token)
+            return response
+    return middleware
+
+
+def metrics_view(request):
+    """Метрики в текстовом формате Prometheus.
+
+    Под gunicorn воркеры пишут метрики в PROMETHEUS_MULTIPROC_DIR, и
+    ответ собирается по всем воркерам, а не только по ответившему.
+    """
+    registry = REGISTRY
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return HttpResponse(
+        generate_latest(registry), content_type=CONTENT_TYPE_LATEST
+    )
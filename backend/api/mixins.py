@@ -1,4 +1,16 @@
+from functools import update_wrapper, wraps
+from hashlib import md5
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
 from rest_framework import mixins, viewsets
+from rest_framework.response import Response
+
+from api.cache import get_reference
+from api.db import check_connections
 
 
 class ListRetrieveViewSet(
@@ -8,3 +20,147 @@ class ListRetrieveViewSet(
     viewsets.GenericViewSet
 ):
     pass
+
+
+def database_sync_to_async(func):
+    """Выполняет синхронный код с запросами к базе в пуле потоков.
+
+    Потоки пула не получают сигналов начала и конца запроса, поэтому
+    соединения с базой проверяются и закрываются здесь по тем же правилам.
+    """
+    @wraps(func)
+    def inner(*args, **kwargs):
+        close_old_connections()
+        check_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(inner, thread_sensitive=False)
+
+
+def rendered(view):
+    """Рендерит ответ DRF в том же потоке, что и представление."""
+    @wraps(view)
+    def inner(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        if callable(getattr(response, 'render', None)):
+            response.render()
+        return response
+    return inner
+
+
+class AsyncReadMixin:
+    """Асинхронное чтение в режиме ASGI.
+
+    Синхронные представления Django под ASGI выполняет по одному в общем
+    потоке воркера, так что один медленный запрос задерживает остальные.
+    GET-запросы к действиям из async_actions обслуживает асинхронное
+    представление: аутентификация, запросы к базе, сериализация и
+    рендеринг идут в пуле потоков и не ждут друг друга. Прочие методы
+    выполняются как обычно. Под WSGI (ASYNC_VIEWS выключен) вьюсет
+    не меняется.
+    """
+
+    async_actions = ('list', 'retrieve')
+
+    @classmethod
+    def as_view(cls, actions=None, **initkwargs):
+        view = super().as_view(actions, **initkwargs)
+        if (
+            not settings.ASYNC_VIEWS
+            or actions.get('get') not in cls.async_actions
+        ):
+            return view
+        read = database_sync_to_async(rendered(view))
+        write = sync_to_async(view)
+
+        async def async_view(request, *args, **kwargs):
+            if request.method in ('GET', 'HEAD'):
+                return await read(request, *args, **kwargs)
+            return await write(request, *args, **kwargs)
+
+        # Атрибуты cls, actions и csrf_exempt нужны роутеру и Django.
+        return update_wrapper(async_view, view)
+
+
+class ConditionalGetMixin:
+    """Поддержка условных GET-запросов для list и retrieve.
+
+    Вьюсет описывает состояние данных методом get_etag_parts(). ETag
+    дополняется версией связей пользователя и адресом запроса; при
+    совпадении с If-None-Match ответ 304 отдаётся до сериализации.
+    """
+
+    def get_etag_parts(self):
+        """Значения, от которых зависит ответ, или None."""
+        return None
+
+    def get_last_modified(self):
+        """Время изменения данных ответа или None."""
+        return None
+
+    def conditional(self, handler, request, *args, **kwargs):
+        parts = self.get_etag_parts()
+        if parts is None:
+            return handler(request, *args, **kwargs)
+        user = request.user
+        if user.is_authenticated:
+            parts = (*parts, user.id, user.relations_version)
+        etag = quote_etag(md5(
+            ':'.join(map(str, (*parts, request.get_full_path()))).encode()
+        ).hexdigest())
+        last_modified = None
+        if user.is_anonymous:
+            last_modified = self.get_last_modified()
+            if last_modified is not None:
+                last_modified = int(last_modified.timestamp())
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is None:
+            response = handler(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+            patch_vary_headers(response, ('Authorization',))
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(super().retrieve, request, *args, **kwargs)
+
+
+class ReferenceCacheMixin:
+    """Отдаёт list и retrieve справочника из кэша get_reference.
+
+    Ключ включает имя вьюсета и параметры запроса, поэтому результаты
+    с разными фильтрами кэшируются отдельно.
+    """
+
+    def get_cache_key(self, request, *parts):
+        params = '&'.join(sorted(
+            f'{key}={value}' for key, value in request.query_params.items()
+        ))
+        return ':'.join(map(str, (self.basename, *parts, params)))
+
+    def cached_response(self, key, handler, request, *args, **kwargs):
+        data = get_reference(
+            key, lambda: handler(request, *args, **kwargs).data
+        )
+        return Response(data)
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(
+            self.get_cache_key(request, 'list'),
+            super().list, request, *args, **kwargs
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(
+            self.get_cache_key(request, 'detail', kwargs[self.lookup_field]),
+            super().retrieve, request, *args, **kwargs
+        )
@@ -1,7 +1,140 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+
 from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def keyset_filter(ordering, values):
+    """Условие «строго после ключа values» для сортировки ordering.
+
+    Первое поле дополнительно ограничено нестрогим неравенством: по нему
+    база начинает просмотр индекса сразу с нужного места.
+    """
+    keyset = Q()
+    for position, field in enumerate(ordering):
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        condition = Q(**{f'{field.lstrip("-")}__{lookup}': values[position]})
+        for previous, value in zip(ordering[:position], values):
+            condition &= Q(**{previous.lstrip('-'): value})
+        keyset |= condition
+    first = ordering[0]
+    lookup = 'lte' if first.startswith('-') else 'gte'
+    return Q(**{f'{first.lstrip("-")}__{lookup}': values[0]}) & keyset
+
+
+def get_ordering_fields(queryset, ordering):
+    """Поля модели или аннотации queryset, по которым идёт сортировка."""
+    fields = []
+    for name in ordering:
+        name = name.lstrip('-')
+        annotation = queryset.query.annotations.get(name)
+        if annotation is not None:
+            fields.append(annotation.output_field)
+        else:
+            fields.append(queryset.model._meta.get_field(name))
+    return fields
 
 
 class LimitPagination(PageNumberPagination):
+    """Пагинация по номеру страницы с опциональным режимом курсора.
+
+    Если в запросе передан параметр cursor (в том числе пустой), страница
+    выбирается по ключу сортировки cursor_ordering вьюсета: без OFFSET и
+    без подсчёта общего количества записей. Размер страницы по-прежнему
+    задаётся параметром limit.
+    """
+
     page_size = settings.PAGE_SIZE
     page_size_query_param = 'limit'
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Некорректный курсор.'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_mode = (
+            self.cursor_query_param in request.query_params
+            and getattr(view, 'cursor_ordering', None) is not None
+        )
+        if not self.cursor_mode:
+            return super().paginate_queryset(queryset, request, view)
+        ordering = view.cursor_ordering
+
+        def fetch(values, limit):
+            page = queryset.order_by(*ordering)
+            if values is not None:
+                page = page.filter(keyset_filter(ordering, values))
+            return list(page[:limit])
+
+        return self.paginate_keyset(fetch, request, ordering, queryset)
+
+    def paginate_keyset(self, fetch, request, ordering, queryset):
+        """Курсорная пагинация по произвольному источнику данных.
+
+        fetch(values, limit) возвращает не больше limit объектов в порядке
+        ordering, идущих строго после ключа values (None — с начала).
+        По queryset определяются поля, которыми проверяется курсор.
+        """
+        self.cursor_mode = True
+        self.request = request
+        self.ordering = ordering
+        self.fields = get_ordering_fields(queryset, ordering)
+        page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        values = self.decode_cursor(cursor) if cursor else None
+        page = fetch(values, page_size + 1)
+        self.has_next = len(page) > page_size
+        self.page = page[:page_size]
+        return self.page
+
+    def encode_cursor(self, obj):
+        values = [getattr(obj, field.lstrip('-')) for field in self.ordering]
+        return urlsafe_b64encode(
+            json.dumps(values, default=str).encode()
+        ).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            values = json.loads(urlsafe_b64decode(cursor.encode()))
+            if not isinstance(values, list) or len(values) != len(
+                self.fields
+            ):
+                raise ValueError(cursor)
+            return [
+                self.clean_cursor_value(field, value)
+                for field, value in zip(self.fields, values)
+            ]
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def clean_cursor_value(self, field, value):
+        """Приводит значение к типу поля, чтобы подделка не дошла до базы."""
+        value = field.to_python(value)
+        if value is None:
+            raise ValueError(value)
+        field.run_validators(value)
+        return value
+
+    def get_next_link(self):
+        if not self.cursor_mode:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            self.encode_cursor(self.page[-1]),
+        )
+
+    def get_paginated_response(self, data):
+        if not self.cursor_mode:
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
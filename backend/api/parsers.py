@@ -0,0 +1,36 @@
+from django.conf import settings
+from rest_framework import parsers, status
+from rest_framework.exceptions import APIException
+
+
+class RequestTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = 'Слишком большой запрос.'
+    default_code = 'request_too_large'
+
+
+class SizeLimitMixin:
+    """Отклоняет тело запроса больше MAX_REQUEST_SIZE до его чтения."""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        request = (parser_context or {}).get('request')
+        if request is not None:
+            try:
+                length = int(request.META.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                length = 0
+            if length > settings.MAX_REQUEST_SIZE:
+                raise RequestTooLarge
+        return super().parse(stream, media_type, parser_context)
+
+
+class JSONParser(SizeLimitMixin, parsers.JSONParser):
+    pass
+
+
+class FormParser(SizeLimitMixin, parsers.FormParser):
+    pass
+
+
+class MultiPartParser(SizeLimitMixin, parsers.MultiPartParser):
+    """Файлы больше FILE_UPLOAD_MAX_MEMORY_SIZE Django пишет на диск."""
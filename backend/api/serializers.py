@@ -1,19 +1,35 @@
 import base64
+import binascii
+import io
+import os
+import uuid
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import InMemoryUploadedFile, UploadedFile
 from django.db import transaction
+from django.db.models import prefetch_related_objects
 from djoser.serializers import UserCreateSerializer, UserSerializer
 from rest_framework import serializers, status
-from rest_framework.serializers import IntegerField, SerializerMethodField
-
+from rest_framework.serializers import SerializerMethodField
+
+from api.cache import get_tags_by_id
+from api.services import get_recipes_limit, get_user_relations
+from api.uploads import (
+    BASE64_CHUNK_SIZE,
+    BASE64_MARKER,
+    DecodedTemporaryFile,
+    is_image_header
+)
+from recipes.images import renditions_field
 from recipes.models import (
     Favorite,
     Ingredient,
     Recipe,
     RecipesIngredients,
-    ShoppingCart,
+    ShoppingCartTotal,
     Tag
 )
 from users.models import Subscribe
@@ -22,16 +38,123 @@ User = get_user_model()
 
 
 class Base64ImageField(serializers.ImageField):
-    """Кастомное поле для сериализации изображения в формате base64."""
+    """Изображение строкой data:image/...;base64,... или файлом.
+
+    Файл принимается из запроса multipart/form-data без накладных
+    расходов base64. Строка base64 декодируется частями: небольшие
+    картинки остаются в памяти, крупные пишутся во временный файл, как
+    это делают обработчики загрузки Django.
+    """
+
+    default_error_messages = {
+        'invalid_dimensions': (
+            'Стороны изображения должны быть от {min_side} '
+            'до {max_side} пикселей.'
+        ),
+        'invalid_base64': 'Некорректная строка base64.',
+        'max_size': 'Размер изображения не должен превышать {max_size} МБ.',
+    }
 
     def to_internal_value(self, data):
         if isinstance(data, str) and data.startswith('data:image'):
-            format, imgstr = data.split(';base64,')
-            ext = format.split('/')[-1]
+            data = self.decode_base64(data)
+        elif isinstance(data, UploadedFile):
+            if data.size > settings.MAX_IMAGE_UPLOAD_SIZE:
+                self.fail_max_size()
+            data.name = uuid.uuid4().hex + os.path.splitext(data.name)[1]
+
+        file = super().to_internal_value(data)
+        if not all(
+            settings.IMAGE_MIN_SIDE <= side <= settings.IMAGE_MAX_SIDE
+            for side in file.image.size
+        ):
+            self.fail(
+                'invalid_dimensions',
+                min_side=settings.IMAGE_MIN_SIDE,
+                max_side=settings.IMAGE_MAX_SIDE,
+            )
+        return file
+
+    def fail_max_size(self):
+        self.fail(
+            'max_size', max_size=f'{settings.MAX_IMAGE_UPLOAD_SIZE / 2**20:g}'
+        )
+
+    def decode_base64(self, data):
+        header_end = data.find(BASE64_MARKER)
+        if header_end == -1:
+            self.fail('invalid_base64')
+        content_type = data[len('data:'):header_end]
+        name = f'{uuid.uuid4().hex}.{content_type.split("/")[-1]}'
+        start = header_end + len(BASE64_MARKER)
+        if (len(data) - start) * 3 // 4 > settings.MAX_IMAGE_UPLOAD_SIZE:
+            self.fail_max_size()
+
+        file = io.BytesIO()
+        size, tail = 0, ''
+        for offset in range(start, len(data), BASE64_CHUNK_SIZE):
+            chunk = tail + ''.join(
+                data[offset:offset + BASE64_CHUNK_SIZE].split()
+            )
+            cut = len(chunk) - len(chunk) % 4
+            chunk, tail = chunk[:cut], chunk[cut:]
+            try:
+                decoded = base64.b64decode(chunk, validate=True)
+            except binascii.Error:
+                self.fail('invalid_base64')
+            if not size and not is_image_header(decoded):
+                self.fail('invalid_image')
+            if (
+                isinstance(file, io.BytesIO)
+                and size + len(decoded) > settings.FILE_UPLOAD_MAX_MEMORY_SIZE
+            ):
+                buffer = file
+                file = DecodedTemporaryFile(name, content_type)
+                file.write(buffer.getbuffer())
+            file.write(decoded)
+            size += len(decoded)
+        if tail or not size:
+            self.fail('invalid_base64')
+
+        file.seek(0)
+        if isinstance(file, io.BytesIO):
+            return InMemoryUploadedFile(
+                file, None, name, content_type, size, None
+            )
+        file.size = size
+        return file
 
-            data = ContentFile(base64.b64decode(imgstr), name='temp.' + ext)
 
-        return super().to_internal_value(data)
+class ImageRenditionsField(serializers.Field):
+    """Ссылки на уменьшенные копии изображения: {ширина: {формат: url}}.
+
+    Пока копии не готовы, возвращает пустой словарь, и клиент
+    показывает оригинал.
+    """
+
+    def __init__(self, image_field, **kwargs):
+        self.image_field = image_field
+        kwargs['source'] = '*'
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, instance):
+        image = getattr(instance, self.image_field)
+        renditions = getattr(instance, renditions_field(self.image_field))
+        if not image or renditions.get('source') != image.name:
+            return {}
+        return self.build_urls(renditions['widths'])
+
+    def build_urls(self, widths):
+        request = self.context.get('request')
+        build = request.build_absolute_uri if request else str
+        return {
+            width: {
+                format: build(default_storage.url(name))
+                for format, name in files.items()
+            }
+            for width, files in widths.items()
+        }
 
 
 class CustomUserCreateSerializer(UserCreateSerializer):
@@ -63,6 +186,7 @@ class CustomUserSerializer(UserSerializer):
 
     is_subscribed = SerializerMethodField(read_only=True)
     avatar = Base64ImageField(allow_null=True, required=False)
+    avatar_renditions = ImageRenditionsField('avatar')
 
     class Meta:
         model = User
@@ -74,13 +198,16 @@ class CustomUserSerializer(UserSerializer):
             'last_name',
             'is_subscribed',
             'avatar',
+            'avatar_renditions',
         )
 
     def get_is_subscribed(self, obj):
         request = self.context.get('request')
         if request is None or request.user.is_anonymous:
             return False
-        return request.user.follower.filter(author=obj).exists()
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
+        return obj.id in get_user_relations(request).subscribed_author_ids
 
 
 class UserAvatarSerializer(serializers.ModelSerializer):
@@ -124,28 +251,51 @@ class RecipeIngredientSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'measurement_unit', 'amount')
 
 
+class ShoppingCartTotalSerializer(serializers.ModelSerializer):
+    """Сериализатор итогов списка покупок."""
+
+    id = serializers.ReadOnlyField(source='ingredient.id')
+    name = serializers.ReadOnlyField(source='ingredient.name')
+    measurement_unit = serializers.ReadOnlyField(
+        source='ingredient.measurement_unit'
+    )
+
+    class Meta:
+        model = ShoppingCartTotal
+        fields = ('id', 'name', 'measurement_unit', 'amount')
+
+
 class AddIngredientSerializer(serializers.ModelSerializer):
     """Сериализатор для добавления ингредиента."""
 
-    id = serializers.PrimaryKeyRelatedField(
-        queryset=Ingredient.objects.all(),
-        source='ingredient',
-        write_only=True)
+    # Существование ингредиентов RecipeSerializer проверяет одним
+    # запросом на все строки, а не запросом на каждую.
+    id = serializers.IntegerField(min_value=1, write_only=True)
 
     class Meta:
         model = RecipesIngredients
         fields = ('id', 'amount')
 
 
+class CachedTagField(serializers.PrimaryKeyRelatedField):
+    """Поле тега, которое проверяет id по кэшу справочника тегов."""
+
+    def to_internal_value(self, data):
+        try:
+            return get_tags_by_id()[int(data)]
+        except KeyError:
+            self.fail('does_not_exist', pk_value=data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+
 class RecipeSerializer(serializers.ModelSerializer):
     """Сериализатор создания рецепта."""
 
     author = CustomUserSerializer(read_only=True)
     image = Base64ImageField()
     ingredients = AddIngredientSerializer(many=True)
-    tags = serializers.PrimaryKeyRelatedField(
-        many=True, queryset=Tag.objects.all()
-    )
+    tags = CachedTagField(many=True, queryset=Tag.objects.all())
 
     class Meta:
         model = Recipe
@@ -165,18 +315,27 @@ class RecipeSerializer(serializers.ModelSerializer):
             )
         if len(tags) != len(set(tags)):
             raise serializers.ValidationError('Теги должны быть уникальными.')
-        if len(set(val['id'] for val in ingredients)) != len(ingredients):
+        ids = {ingredient['id'] for ingredient in ingredients}
+        if len(ids) != len(ingredients):
             raise serializers.ValidationError(
                 'Ингредиенты должны быть уникальными.'
             )
+        missing = ids - set(Ingredient.objects.filter(
+            pk__in=ids
+        ).values_list('pk', flat=True))
+        if missing:
+            raise serializers.ValidationError({'ingredients': [
+                f'Ингредиент с id {pk} не существует.'
+                for pk in sorted(missing)
+            ]})
         return data
 
     def create_ingredients(self, recipe, ingredients):
         RecipesIngredients.objects.bulk_create(
             RecipesIngredients(
                 recipe=recipe,
-                ingredient=ingredient.get['id'],
-                amount=ingredient.get('amount')
+                ingredient_id=ingredient['id'],
+                amount=ingredient['amount']
             ) for ingredient in ingredients)
 
     @transaction.atomic
@@ -198,12 +357,20 @@ class RecipeSerializer(serializers.ModelSerializer):
     def update(self, instance, validated_data):
         tags = validated_data.pop('tags')
         ingredients = validated_data.pop('ingredients')
-        RecipesIngredients.objects.filter(recipe=instance).delete()
-        instance.tags.set(tags)
-        self.create_ingredients(instance, ingredients)
+        if {tag.pk for tag in tags} != {tag.pk for tag in instance.tags.all()}:
+            instance.tags.set(tags)
+        RecipesIngredients.objects.sync(instance.id, {
+            ingredient['id']: ingredient['amount']
+            for ingredient in ingredients
+        })
         return super().update(instance, validated_data)
 
     def to_representation(self, instance):
+        # После записи DRF сбрасывает предзагрузку: без неё ингредиенты
+        # ответа читались бы по запросу на каждый.
+        prefetch_related_objects(
+            [instance], 'tags', 'ingredient_list__ingredient'
+        )
         context = {'request': self.context.get('request')}
         return GetRecipeSerializer(instance, context=context).data
 
@@ -218,57 +385,71 @@ class GetRecipeSerializer(serializers.ModelSerializer):
     is_favorited = serializers.SerializerMethodField(read_only=True)
     is_in_shopping_cart = serializers.SerializerMethodField(read_only=True)
     image = Base64ImageField(required=False)
+    image_renditions = ImageRenditionsField('image')
 
     class Meta:
         model = Recipe
         fields = ('id', 'tags', 'author', 'ingredients',
                   'is_favorited', 'is_in_shopping_cart',
-                  'name', 'image', 'text', 'cooking_time')
+                  'name', 'image', 'image_renditions', 'text',
+                  'cooking_time')
         read_only_fields = ('id', 'author',)
 
     def get_is_favorited(self, object):
         """Проверяет, добавлен ли рецепт в избранное."""
 
-        user = self.context.get('request').user
-        if user.is_anonymous:
+        request = self.context.get('request')
+        if request is None or request.user.is_anonymous:
             return False
-        return object.favorites.filter(user=user).exists()
+        return object.id in get_user_relations(request).favorited_recipe_ids
 
     def get_is_in_shopping_cart(self, object):
         """Проверяет, добавлен ли рецепт в список покупок."""
 
-        user = self.context.get('request').user
-        if user.is_anonymous:
+        request = self.context.get('request')
+        if request is None or request.user.is_anonymous:
             return False
-        return object.shopping_cart.filter(user=user).exists()
+        return object.id in get_user_relations(request).cart_recipe_ids
 
 
-class ShortRecipeSerializer(serializers.ModelSerializer):
+class CoverageRecipeSerializer(GetRecipeSerializer):
+    """Рецепт с числом имеющихся и недостающих ингредиентов."""
 
-    class Meta:
-        model = Recipe
-        fields = ('id', 'name', 'image', 'cooking_time')
+    matched_ingredients = serializers.IntegerField(read_only=True)
+    missing_ingredients = serializers.IntegerField(read_only=True)
 
+    class Meta(GetRecipeSerializer.Meta):
+        fields = GetRecipeSerializer.Meta.fields + (
+            'matched_ingredients', 'missing_ingredients'
+        )
 
-class ShoppingCartSerializer(serializers.ModelSerializer):
-    """Список покупок."""
 
-    class Meta:
-        model = ShoppingCart
+class CoverageQuerySerializer(serializers.Serializer):
+    """Параметры поиска рецептов по имеющимся ингредиентам."""
 
-    def validate(self, data, pk):
-        user = data.get('user')
-        if self.Meta.model.objects.filter(user=user, recipe__id=pk).exists():
-            raise ValidationError(
-                {'errors': 'Рецепт уже добавлен!'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-        return data
+    ingredients = serializers.ListField(
+        child=serializers.IntegerField(min_value=1), allow_empty=False
+    )
+    max_missing = serializers.IntegerField(min_value=0, required=False)
 
-    def to_representation(self, instance):
-        return ShortRecipeSerializer(
-            instance.recipe, context=self.context
-        ).data
+
+class RecipeIdsSerializer(serializers.Serializer):
+    """Рецепты для массового добавления в избранное или список покупок."""
+
+    recipes = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=settings.BULK_RECIPES_LIMIT,
+    )
+
+
+class ShortRecipeSerializer(serializers.ModelSerializer):
+
+    image_renditions = ImageRenditionsField('image')
+
+    class Meta:
+        model = Recipe
+        fields = ('id', 'name', 'image', 'image_renditions', 'cooking_time')
 
 
 class FavoriteSerializer(serializers.ModelSerializer):
@@ -281,9 +462,8 @@ class FavoriteSerializer(serializers.ModelSerializer):
     def validate(self, data):
         user, recipe = data.get('user'), data.get('recipe')
         if self.Meta.model.objects.filter(user=user, recipe=recipe).exists():
-            raise ValidationError(
-                {'errors': 'Рецепт уже добавлен!'},
-                status=status.HTTP_400_BAD_REQUEST
+            raise serializers.ValidationError(
+                {'errors': 'Рецепт уже добавлен!'}
             )
         return data
 
@@ -297,7 +477,7 @@ class SubscribeSerializer(CustomUserSerializer):
     """Сериализатор для добавления/удаления подписки, просмотра подписок."""
 
     recipes = SerializerMethodField()
-    recipes_count = IntegerField(source='recipes.count', read_only=True)
+    recipes_count = serializers.IntegerField(read_only=True)
 
     class Meta(CustomUserSerializer.Meta):
         fields = (
@@ -310,6 +490,7 @@ class SubscribeSerializer(CustomUserSerializer):
             'recipes',
             'recipes_count',
             'avatar',
+            'avatar_renditions',
         )
         read_only_fields = (
             'email',
@@ -341,9 +522,11 @@ class SubscribeSerializer(CustomUserSerializer):
     def get_recipes(self, obj):
         request = self.context.get('request')
         context = {'request': request}
-        recipes_limit = request.query_params.get('recipes_limit')
-        recipes = obj.recipes.all()
-        if recipes_limit:
-            recipes = recipes[:int(recipes_limit)]
+        recipes = getattr(obj, 'recent_recipes', None)
+        if recipes is None:
+            recipes = obj.recipes.all()
+            recipes_limit = get_recipes_limit(request)
+            if recipes_limit is not None:
+                recipes = recipes[:recipes_limit]
         serializer = ShortRecipeSerializer(recipes, context=context, many=True)
         return serializer.data
@@ -0,0 +1,165 @@
+from django.conf import settings
+from django.utils.functional import cached_property
+
+from api.paginators import keyset_filter
+from recipes.models import (
+    Favorite,
+    FeedEntry,
+    Recipe,
+    ShoppingCart,
+    fold_search_name
+)
+from users.models import Subscribe, User
+
+FEED_ORDERING = ('-pub_date', '-id')
+
+RECENT_RECIPES_SQL = '''
+    SELECT id, name, image, image_renditions, cooking_time, author_id
+    FROM (
+        SELECT id, name, image, image_renditions, cooking_time, author_id,
+               ROW_NUMBER() OVER (
+                   PARTITION BY author_id ORDER BY pub_date DESC, id DESC
+               ) AS row_number
+        FROM {table}
+        WHERE author_id IN ({authors})
+    ) AS ranked
+    WHERE row_number <= %s
+    ORDER BY author_id, row_number
+'''
+
+
+def search_ingredients(queryset, query, limit):
+    """Подсказки ингредиентов для поиска по мере ввода.
+
+    Сначала идут совпадения по началу названия (индекс с pattern ops),
+    затем совпадения по вхождению (триграммный индекс); всего не больше
+    limit записей.
+    """
+    search = fold_search_name(query)
+    found = list(
+        queryset.filter(
+            search_name__startswith=search
+        ).order_by('search_name')[:limit]
+    )
+    if len(found) < limit:
+        found.extend(
+            queryset.filter(
+                search_name__contains=search
+            ).exclude(
+                search_name__startswith=search
+            ).order_by('search_name')[:limit - len(found)]
+        )
+    return found
+
+
+def get_recipes_limit(request):
+    """Возвращает значение параметра recipes_limit или None."""
+    recipes_limit = request.query_params.get('recipes_limit', '')
+    if not recipes_limit.isdigit():
+        return None
+    return int(recipes_limit)
+
+
+def attach_recent_recipes(authors, limit=None):
+    """Подгружает последние рецепты авторов страницы одним запросом.
+
+    Рецепты раскладываются по авторам в атрибут recent_recipes. При
+    заданном limit отбор по каждому автору выполняется в базе оконной
+    функцией ROW_NUMBER(), а не срезом отдельного запроса на автора.
+    """
+    authors = list(authors)
+    by_author = {author.id: [] for author in authors}
+    if by_author:
+        if limit is None:
+            recipes = Recipe.objects.filter(
+                author__in=by_author
+            ).only(
+                'id', 'name', 'image', 'image_renditions', 'cooking_time',
+                'author_id',
+            )
+        else:
+            recipes = Recipe.objects.raw(
+                RECENT_RECIPES_SQL.format(
+                    table=Recipe._meta.db_table,
+                    authors=', '.join(['%s'] * len(by_author)),
+                ),
+                [*by_author, limit],
+            )
+        for recipe in recipes:
+            by_author[recipe.author_id].append(recipe)
+    for author in authors:
+        author.recent_recipes = by_author[author.id]
+    return authors
+
+
+class UserRelations:
+    """Связи текущего пользователя, общие для всех сериализаторов запроса.
+
+    Каждое множество загружается одним запросом при первом обращении,
+    после чего флаги is_subscribed, is_favorited и is_in_shopping_cart
+    проверяются поиском по множеству.
+    """
+
+    def __init__(self, user):
+        self.user = user
+
+    def _ids(self, queryset, field):
+        if self.user.is_anonymous:
+            return frozenset()
+        return frozenset(
+            queryset.filter(user=self.user).values_list(field, flat=True)
+        )
+
+    @cached_property
+    def subscribed_author_ids(self):
+        return self._ids(Subscribe.objects, 'author_id')
+
+    @cached_property
+    def favorited_recipe_ids(self):
+        return self._ids(Favorite.objects, 'recipe_id')
+
+    @cached_property
+    def cart_recipe_ids(self):
+        return self._ids(ShoppingCart.objects, 'recipe_id')
+
+
+def get_user_relations(request):
+    """Возвращает кэш связей пользователя, привязанный к запросу."""
+    relations = getattr(request, '_user_relations', None)
+    if relations is None:
+        relations = UserRelations(request.user)
+        request._user_relations = relations
+    return relations
+
+
+def get_feed(user, queryset, after, limit):
+    """Рецепты авторов, на которых подписан user, от новых к старым.
+
+    Рецепты большинства авторов читаются из ленты пользователя, куда они
+    попадают при публикации. Рецепты авторов, у которых подписчиков
+    больше FEED_FANOUT_LIMIT, подмешиваются прямо из таблицы рецептов.
+    Оба источника читаются по индексам с тем же ключом, что и у курсора.
+    """
+    entries = FeedEntry.objects.filter(user=user).order_by(
+        '-pub_date', '-recipe'
+    )
+    celebrities = list(User.objects.filter(
+        following_author__user=user,
+        followers_count__gt=settings.FEED_FANOUT_LIMIT,
+    ).values_list('pk', flat=True))
+    fan_in = Recipe.objects.filter(author__in=celebrities).order_by(
+        *FEED_ORDERING
+    )
+    if after is not None:
+        entries = entries.filter(
+            keyset_filter(('-pub_date', '-recipe'), after)
+        )
+        fan_in = fan_in.filter(keyset_filter(FEED_ORDERING, after))
+    keys = set(entries.values_list('pub_date', 'recipe')[:limit])
+    if celebrities:
+        keys.update(fan_in.values_list('pub_date', 'id')[:limit])
+    keys = sorted(keys, reverse=True)[:limit]
+    recipes = queryset.in_bulk([recipe_id for _, recipe_id in keys])
+    return [
+        recipes[recipe_id] for _, recipe_id in keys if recipe_id in recipes
+    ]
@@ -0,0 +1,46 @@
+import os
+import tempfile
+import weakref
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+
+BASE64_MARKER = ';base64,'
+# Кратно 4, чтобы каждый кусок декодировался независимо.
+BASE64_CHUNK_SIZE = 64 * 1024
+IMAGE_SIGNATURES = (
+    b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a'
+)
+
+
+def is_image_header(head):
+    """Проверяет сигнатуру JPEG, PNG, GIF или WebP в начале файла."""
+    return head.startswith(IMAGE_SIGNATURES) or (
+        head[:4] == b'RIFF' and head[8:12] == b'WEBP'
+    )
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class DecodedTemporaryFile(UploadedFile):
+    """Декодированная из base64 картинка во временном файле.
+
+    Как и TemporaryUploadedFile, отдаёт temporary_file_path(), поэтому
+    Pillow читает её с диска, а хранилище перемещает файл без копирования.
+    Если файл так и не был сохранён, он удаляется вместе с объектом.
+    """
+
+    def __init__(self, name, content_type):
+        file = tempfile.NamedTemporaryFile(
+            suffix='.upload', dir=settings.FILE_UPLOAD_TEMP_DIR, delete=False
+        )
+        super().__init__(file, name, content_type, 0, None)
+        weakref.finalize(self, _remove, file.name)
+
+    def temporary_file_path(self):
+        return self.file.name
@@ -1,7 +1,10 @@
+from functools import partial
+
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Sum
-from django.http import HttpResponse
+from django.db import transaction
+from django.db.models import F, Value
+from django.http import FileResponse, Http404, HttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from django_filters.rest_framework import DjangoFilterBackend
@@ -16,32 +19,61 @@ from rest_framework.permissions import (
 from rest_framework.response import Response
 from rest_framework.viewsets import ReadOnlyModelViewSet
 
+from api.exporters import SHOPPING_LIST_RENDERERS, build_shopping_list
 from api.filters import IngredientFilter, RecipeFilter
+from api.mixins import AsyncReadMixin, ConditionalGetMixin, ReferenceCacheMixin
 from api.paginators import LimitPagination
 from api.serializers import (
+    CoverageQuerySerializer,
+    CoverageRecipeSerializer,
     CustomUserSerializer,
     FavoriteSerializer,
     GetRecipeSerializer,
     IngredientSerializer,
+    RecipeIdsSerializer,
     RecipeSerializer,
+    ShoppingCartTotalSerializer,
+    ShortRecipeSerializer,
     SubscribeSerializer,
     TagSerializer,
     UserAvatarSerializer
 )
-from recipes.models import Ingredient, Recipe, RecipesIngredients, Tag
+from api.services import (
+    FEED_ORDERING,
+    attach_recent_recipes,
+    get_feed,
+    get_recipes_limit,
+    search_ingredients
+)
+from recipes.coverage import coverage_index
+from recipes.models import Favorite, Ingredient, Recipe, ShoppingCart, Tag
+from recipes.versions import FAVORITES, RECIPES, REFERENCE, get_version
 from users.models import Subscribe
 
 User = get_user_model()
 
+# Сортировки списка рецептов, для которых есть курсорный режим.
+CURSOR_ORDERINGS = {
+    '-pub_date': ('-pub_date', '-id'),
+    '-favorites_count': ('-favorites_count', '-id'),
+}
+
 
-class UsersViewSet(UserViewSet):
+class UsersViewSet(AsyncReadMixin, UserViewSet):
     """ViewSet для модели Пользователя."""
 
-    queryset = User.objects.all()
+    async_actions = ('me',)
+    queryset = User.objects.order_by('id')
     serializer_class = CustomUserSerializer
     pagination_class = LimitPagination
     permission_classes = [IsAuthenticatedOrReadOnly]
 
+    @property
+    def cursor_ordering(self):
+        if self.action == 'subscriptions':
+            return ('-subscription_id',)
+        return ('id',)
+
     @action(
         methods=['PUT', 'DELETE'],
         permission_classes=[IsAuthenticated],
@@ -76,14 +108,14 @@ class UsersViewSet(UserViewSet):
         if request.method == 'POST':
             if author == user:
                 return Response(status=status.HTTP_400_BAD_REQUEST)
+            Subscribe.objects.create(user=user, author=author)
             serializer = SubscribeSerializer(
                 author, context={'request': request})
-            Subscribe.objects.create(user=user, author=author)
             return Response(serializer.data, status=status.HTTP_201_CREATED)
-        is_subscribed = user.follower.filter(author=author).exists()
+        is_subscribed = user.subscriber.filter(author=author).exists()
         if not is_subscribed:
             return Response(status=status.HTTP_400_BAD_REQUEST)
-        user.follower.filter(author=author).delete()
+        user.subscriber.filter(author=author).delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(
@@ -94,8 +126,15 @@ class UsersViewSet(UserViewSet):
     def subscriptions(self, request):
         """Метод для подписки."""
         user = request.user
-        follows = User.objects.filter(subscribing__user=user)
-        page = self.paginate_queryset(follows)
+        follows = User.objects.filter(
+            following_author__user=user
+        ).annotate(
+            is_subscribed=Value(True),
+            subscription_id=F('following_author__id'),
+        ).order_by('-subscription_id')
+        page = attach_recent_recipes(
+            self.paginate_queryset(follows), get_recipes_limit(request)
+        )
         serializer = SubscribeSerializer(page,
                                          many=True,
                                          context={'request': request})
@@ -113,7 +152,12 @@ class UsersViewSet(UserViewSet):
         return Response(data=serializer.data, status=status.HTTP_200_OK)
 
 
-class IngredientViewSet(ReadOnlyModelViewSet):
+class IngredientViewSet(
+    AsyncReadMixin,
+    ConditionalGetMixin,
+    ReferenceCacheMixin,
+    ReadOnlyModelViewSet,
+):
     """Вьюсет для обработки запросов на получение ингредиентов."""
 
     queryset = Ingredient.objects.all()
@@ -123,8 +167,36 @@ class IngredientViewSet(ReadOnlyModelViewSet):
     permission_classes = [IsAuthenticatedOrReadOnly]
     pagination_class = None
 
+    def get_etag_parts(self):
+        return (REFERENCE, get_version(REFERENCE))
 
-class TagViewSet(ReadOnlyModelViewSet):
+    def list(self, request, *args, **kwargs):
+        query = request.query_params.get('name', '').strip()
+        if not query:
+            return super().list(request, *args, **kwargs)
+        handler = partial(
+            self.cached_response,
+            self.get_cache_key(request, 'search'),
+            self.search,
+        )
+        return self.conditional(handler, request, query)
+
+    def search(self, request, query):
+        ingredients = search_ingredients(
+            self.filter_queryset(self.get_queryset()),
+            query,
+            settings.INGREDIENTS_SEARCH_LIMIT,
+        )
+        serializer = self.get_serializer(ingredients, many=True)
+        return Response(serializer.data)
+
+
+class TagViewSet(
+    AsyncReadMixin,
+    ConditionalGetMixin,
+    ReferenceCacheMixin,
+    ReadOnlyModelViewSet,
+):
     """Вьюсет для обработки запросов на получение тегов."""
 
     queryset = Tag.objects.all()
@@ -132,8 +204,13 @@ class TagViewSet(ReadOnlyModelViewSet):
     permission_classes = [IsAuthenticatedOrReadOnly]
     pagination_class = None
 
+    def get_etag_parts(self):
+        return (REFERENCE, get_version(REFERENCE))
+
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(
+    AsyncReadMixin, ConditionalGetMixin, viewsets.ModelViewSet
+):
     """Вьюсет для работы с рецептами."""
 
     queryset = Recipe.objects.all()
@@ -142,15 +219,67 @@ class RecipeViewSet(viewsets.ModelViewSet):
     filter_backends = (DjangoFilterBackend,)
     filterset_class = RecipeFilter
 
+    @property
+    def cursor_ordering(self):
+        if self.action == 'by_ingredients':
+            return None
+        params = self.request.query_params
+        ordering = params.get('ordering')
+        if params.get('search') and not ordering:
+            # ts_rank — float4: в курсоре он теряет точность, и строки на
+            # границе страницы повторялись бы или пропадали. Поиск
+            # листается по номеру страницы.
+            return None
+        # Прочие сортировки листаются по номеру страницы, а не
+        # подменяются сортировкой по умолчанию.
+        return CURSOR_ORDERINGS.get(ordering or '-pub_date')
+
+    def get_queryset(self):
+        """Отдаёт страницу рецептов за фиксированное число запросов.
+
+        Автор, теги и ингредиенты подгружаются заранее, а признаки
+        избранного, списка покупок и подписки на автора берутся из
+        кэша связей пользователя, общего для всего запроса.
+        """
+        return Recipe.objects.select_related('author').prefetch_related(
+            'tags', 'ingredient_list__ingredient'
+        )
+
+    def get_etag_parts(self):
+        """Список зависит от версии всех рецептов, рецепт — от своей."""
+        reference = get_version(REFERENCE)
+        if self.action == 'list':
+            parts = (RECIPES, get_version(RECIPES), reference)
+            if 'favorites_count' in self.request.query_params.get(
+                'ordering', ''
+            ):
+                # Порядок зависит от счётчиков избранного, которые меняются
+                # без новой версии рецептов.
+                parts += (FAVORITES, get_version(FAVORITES))
+            return parts
+        updated_at = self.get_last_modified()
+        if updated_at is None:
+            return None
+        return (self.kwargs['pk'], updated_at.isoformat(), reference)
+
+    def get_last_modified(self):
+        if self.action != 'retrieve' or not self.kwargs['pk'].isdigit():
+            return None
+        if not hasattr(self, '_updated_at'):
+            self._updated_at = Recipe.objects.filter(
+                pk=self.kwargs['pk']
+            ).values_list('updated_at', flat=True).first()
+        return self._updated_at
+
     def get_serializer_class(self):
-        if self.action in SAFE_METHODS:
+        if self.request.method in SAFE_METHODS:
             return GetRecipeSerializer
         return RecipeSerializer
 
-    def add_to(self, serializer):
+    def perform_create(self, serializer):
         serializer.save(author=self.request.user)
 
-    def delete_from(self, request, *args, **kwargs):
+    def destroy(self, request, *args, **kwargs):
         if self.request.user != self.get_object().author:
             return Response(status=status.HTTP_403_FORBIDDEN)
         return super().destroy(request, *args, **kwargs)
@@ -160,6 +289,7 @@ class RecipeViewSet(viewsets.ModelViewSet):
         detail=True,
         permission_classes=[IsAuthenticated],
     )
+    @transaction.atomic
     def favorite(self, request, pk=None):
         recipe = get_object_or_404(Recipe, id=pk)
         user = request.user
@@ -171,7 +301,7 @@ class RecipeViewSet(viewsets.ModelViewSet):
             serializer.save()
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         if request.method == 'DELETE':
-            is_favorited = user.favourites.filter(recipe=recipe)
+            is_favorited = user.favorites.filter(recipe=recipe)
             if is_favorited.exists():
                 is_favorited.delete()
                 return Response(status=status.HTTP_204_NO_CONTENT)
@@ -180,6 +310,95 @@ class RecipeViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
+    @action(
+        methods=['POST', 'DELETE'],
+        detail=True,
+        permission_classes=[IsAuthenticated],
+    )
+    @transaction.atomic
+    def shopping_cart(self, request, pk=None):
+        """Рецепт в списке покупок: запись одним запросом.
+
+        Повтор не проверяется заранее: INSERT пропускает строку по
+        ограничению unique_shopping_cart, DELETE сообщает число удалённых.
+        Двойной клик даёт 400, а не IntegrityError. Есть ли рецепт вообще,
+        выясняется, только если ничего не записалось.
+        """
+        if not pk.isdigit():
+            raise Http404
+        recipe_id = int(pk)
+        if request.method == 'POST':
+            if ShoppingCart.objects.add(request.user.id, [recipe_id]):
+                serializer = ShortRecipeSerializer(
+                    Recipe.objects.get(pk=recipe_id),
+                    context=self.get_serializer_context(),
+                )
+                return Response(
+                    serializer.data, status=status.HTTP_201_CREATED
+                )
+            error = 'Рецепт уже в списке покупок.'
+        else:
+            if ShoppingCart.objects.remove(request.user.id, [recipe_id]):
+                return Response(status=status.HTTP_204_NO_CONTENT)
+            error = 'Этого рецепта нет в списке покупок.'
+        get_object_or_404(Recipe, id=recipe_id)
+        return Response(
+            data={'errors': error}, status=status.HTTP_400_BAD_REQUEST
+        )
+
+    def change_many(self, request, model):
+        """Добавляет или удаляет рецепты списком, итог — по каждому.
+
+        Статусы: added и exists при добавлении, removed и absent при
+        удалении, not_found для несуществующего рецепта.
+        """
+        serializer = RecipeIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        recipe_ids = list(dict.fromkeys(serializer.validated_data['recipes']))
+        if request.method == 'POST':
+            done = model.objects.add(request.user.id, recipe_ids)
+            done_status, skipped_status = 'added', 'exists'
+        else:
+            done = model.objects.remove(request.user.id, recipe_ids)
+            done_status, skipped_status = 'removed', 'absent'
+        statuses = dict.fromkeys(done, done_status)
+        skipped = [pk for pk in recipe_ids if pk not in statuses]
+        if skipped:
+            existing = set(Recipe.objects.filter(
+                pk__in=skipped
+            ).values_list('pk', flat=True))
+            for pk in skipped:
+                statuses[pk] = (
+                    skipped_status if pk in existing else 'not_found'
+                )
+        return Response([
+            {'id': pk, 'status': statuses[pk]} for pk in recipe_ids
+        ])
+
+    @action(
+        methods=['POST', 'DELETE'],
+        detail=False,
+        url_path='favorite',
+        url_name='favorite-many',
+        permission_classes=[IsAuthenticated],
+    )
+    @transaction.atomic
+    def favorite_many(self, request):
+        """Избранное списком: {"recipes": [id, ...]}."""
+        return self.change_many(request, Favorite)
+
+    @action(
+        methods=['POST', 'DELETE'],
+        detail=False,
+        url_path='shopping_cart',
+        url_name='shopping-cart-many',
+        permission_classes=[IsAuthenticated],
+    )
+    @transaction.atomic
+    def shopping_cart_many(self, request):
+        """Список покупок списком: {"recipes": [id, ...]}."""
+        return self.change_many(request, ShoppingCart)
+
     @action(
         detail=True,
         methods=['GET'],
@@ -192,38 +411,87 @@ class RecipeViewSet(viewsets.ModelViewSet):
             status=status.HTTP_200_OK
         )
 
+    @action(
+        methods=['GET'],
+        detail=False,
+        permission_classes=[IsAuthenticated],
+    )
+    def feed(self, request):
+        """Лента рецептов авторов, на которых подписан пользователь."""
+        page = self.paginator.paginate_keyset(
+            partial(get_feed, request.user, self.get_queryset()),
+            request,
+            FEED_ORDERING,
+            self.get_queryset(),
+        )
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(methods=['GET'], detail=False, url_path='by-ingredients')
+    def by_ingredients(self, request):
+        """Рецепты, которые можно приготовить из имеющихся ингредиентов."""
+        query = CoverageQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        page = self.paginate_queryset(
+            coverage_index.rank(**query.validated_data)
+        )
+        recipes = self.get_queryset().in_bulk(
+            [recipe_id for recipe_id, _, _ in page]
+        )
+        found = []
+        for recipe_id, matched, missing in page:
+            recipe = recipes.get(recipe_id)
+            if recipe is not None:
+                recipe.matched_ingredients = matched
+                recipe.missing_ingredients = missing
+                found.append(recipe)
+        serializer = CoverageRecipeSerializer(
+            found, many=True, context=self.get_serializer_context()
+        )
+        return self.get_paginated_response(serializer.data)
+
+    @action(
+        methods=['GET'],
+        detail=False,
+        permission_classes=[IsAuthenticated],
+    )
+    def shopping_cart_totals(self, request):
+        """Суммарное количество ингредиентов в списке покупок."""
+        totals = request.user.cart_totals.select_related(
+            'ingredient'
+        ).order_by('ingredient__name')
+        serializer = ShoppingCartTotalSerializer(totals, many=True)
+        return Response(serializer.data, status=status.HTTP_200_OK)
+
     @action(
         methods=['GET'],
         detail=False,
         permission_classes=[IsAuthenticated],
     )
     def download_shopping_cart(self, request):
+        renderer = SHOPPING_LIST_RENDERERS.get(
+            request.query_params.get('file_format', 'txt')
+        )
+        if renderer is None:
+            return Response(
+                data={'errors': 'Неизвестный формат файла.'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
         user = request.user
-        if not user.shopping_cart.exists():
+        path = build_shopping_list(user, renderer, timezone.now())
+        if path is None:
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
-        ingredients = (
-            RecipesIngredients.objects.filter(
-                recipe__in_shopping_cart__user=request.user
+        filename = f'{user.username}_shopping_list.{renderer.extension}'
+        if settings.SHOPPING_LIST_X_ACCEL_REDIRECT:
+            response = HttpResponse(content_type=renderer.content_type)
+            response['X-Accel-Redirect'] = settings.MEDIA_URL + (
+                path.relative_to(settings.MEDIA_ROOT).as_posix()
+            )
+        else:
+            response = FileResponse(
+                path.open('rb'), content_type=renderer.content_type
             )
-            .values('ingredient__name', 'ingredient__measurement_unit')
-            .annotate(amount=Sum('amount'))
-        )
-        today = timezone.now()
-        shopping_list = (
-            f'Список покупок для: {user.get_full_name()}\n\n'
-            f'Дата: {today:%d-%m-%Y}\n\n'
-        )
-        shopping_list += '\n'.join([
-            f"- {ingredient['ingredient__name']}" # noqa
-            f"({ingredient['ingredient__measurement_unit']})"
-            f" - {ingredient['quantity']}"
-            for ingredient in ingredients
-        ])
-        shopping_list += f'\n\nFoodgram ({today:%Y})'
-
-        filename = f'{user.username}_shopping_list.txt'
-        response = HttpResponse(shopping_list, content_type='text/plain')
         response['Content-Disposition'] = f'attachment; filename={filename}'
 
         return response
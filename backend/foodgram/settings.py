@@ -12,7 +12,11 @@ SECRET_KEY = os.getenv('SECRET_KEY', 'secret_key')
 
 DEBUG = os.getenv('DEBUG', 'False') == 'True'
 
-ALLOWED_HOSTS = ['158.160.77.229', '127.0.0.1', 'localhost', 'mytopfood.ddns.net']
+# backend — имя сервиса в docker compose, по нему Prometheus читает /metrics.
+ALLOWED_HOSTS = [
+    '158.160.77.229', '127.0.0.1', 'localhost', 'mytopfood.ddns.net',
+    'backend',
+]
 
 CSRF_TRUSTED_ORIGINS = config(
     "CSRF_TRUSTED_ORIGINS",
@@ -22,6 +26,11 @@ CSRF_TRUSTED_ORIGINS = config(
 
 PAGE_SIZE = 6
 
+# Асинхронные представления чтения (AsyncReadMixin); включает foodgram.asgi.
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', 'False') == 'True'
+
+INGREDIENTS_SEARCH_LIMIT = int(os.getenv('INGREDIENTS_SEARCH_LIMIT', 20))
+
 
 INSTALLED_APPS = [
     'django.contrib.admin',
@@ -40,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.metrics.metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -77,7 +87,26 @@ DATABASES = {
         'USER': os.getenv('POSTGRES_USER', 'django'),
         'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
         'HOST': os.getenv('DB_HOST', ''),
-        'PORT': os.getenv('DB_PORT', 5432)
+        'PORT': os.getenv('DB_PORT', 5432),
+        # Соединение живёт между запросами; 0 — закрывать после запроса.
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 60)),
+        # Проверка перед запросом, см. api.db.check_connections.
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', 5)),
+        },
+    }
+}
+
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND',
+            'django.core.cache.backends.filebased.FileBasedCache',
+        ),
+        'LOCATION': os.getenv('CACHE_LOCATION', '/tmp/foodgram_cache'),
+        'OPTIONS': {'MAX_ENTRIES': 10000},
     }
 }
 
@@ -104,6 +133,11 @@ REST_FRAMEWORK = {
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticatedOrReadOnly",
     ],
+    "DEFAULT_PARSER_CLASSES": [
+        "api.parsers.JSONParser",
+        "api.parsers.FormParser",
+        "api.parsers.MultiPartParser",
+    ],
 }
 
 DJOSER = {
@@ -141,10 +175,47 @@ STATIC_ROOT = BASE_DIR / "static"
 MEDIA_URL = "media/"
 MEDIA_ROOT = BASE_DIR / MEDIA_URL
 
+IMAGE_RENDITIONS_DIR = 'renditions'
+IMAGE_RENDITION_WIDTHS = (320, 640, 1280)
+IMAGE_RENDITION_FORMATS = ('webp', 'jpeg')
+IMAGE_MIN_SIDE = 64
+MAX_IMAGE_UPLOAD_SIZE = int(
+    os.getenv('MAX_IMAGE_UPLOAD_SIZE', 10 * 1024 * 1024)
+)
+# Картинка в base64 на треть длиннее; остальные поля рецепта — с запасом.
+MAX_REQUEST_SIZE = MAX_IMAGE_UPLOAD_SIZE * 4 // 3 + 256 * 1024
+IMAGE_MAX_SIDE = 8000
+# 0 — обрабатывать изображения сразу, без пула процессов.
+IMAGE_PROCESSING_WORKERS = int(os.getenv('IMAGE_PROCESSING_WORKERS', 2))
+
+# Через сколько секунд индекс «ингредиент → рецепты» перестраивается.
+COVERAGE_INDEX_MAX_AGE = int(os.getenv('COVERAGE_INDEX_MAX_AGE', 3600))
+
+# Рецепты авторов с большим числом подписчиков не раскладываются по
+# лентам при публикации, а подмешиваются в ленту при чтении.
+FEED_FANOUT_LIMIT = int(os.getenv('FEED_FANOUT_LIMIT', 10000))
+# Сколько последних рецептов автора попадает в ленту при подписке.
+FEED_BACKFILL_SIZE = 100
+
+# Сколько рецептов можно добавить или удалить одним запросом.
+BULK_RECIPES_LIMIT = 200
+
+SHOPPING_LIST_DIR = 'shopping_lists'
+SHOPPING_LIST_X_ACCEL_REDIRECT = (
+    os.getenv('SHOPPING_LIST_X_ACCEL_REDIRECT', 'False') == 'True'
+)
+SHOPPING_LIST_PDF_FONT = os.getenv(
+    'SHOPPING_LIST_PDF_FONT',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+)
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 AUTH_USER_MODEL = "users.User"
 
+# Доля запросов, для которых /metrics собирает число и время SQL.
+METRICS_SAMPLE_RATE = float(os.getenv('METRICS_SAMPLE_RATE', 1.0))
+
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
@@ -154,8 +225,10 @@ LOGGING = {
         },
     },
     "loggers": {
+        # DEBUG пишет каждый SQL-запрос (только при DEBUG=True); для
+        # поиска регрессий есть /metrics.
         "django.db.backends": {
-            "level": "DEBUG",
+            "level": os.getenv("SQL_LOG_LEVEL", "INFO"),
             "handlers": [
                 "console",
             ],
@@ -1,7 +1,11 @@
 from django.contrib import admin
 from django.urls import include, path
 
+from api.metrics import metrics_view
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include("api.urls")),
+    # Не проксируется nginx: доступен только внутри сети контейнеров.
+    path('metrics', metrics_view),
 ]
@@ -0,0 +1,70 @@
+"""Настройки gunicorn: gunicorn -c gunicorn.conf.py.
+
+Режим задаёт SERVER_MODE: wsgi — синхронные воркеры (gthread, если
+GUNICORN_THREADS больше 1), asgi — uvicorn-воркеры с асинхронным
+чтением. Число воркеров по умолчанию считается от доступных процессору
+ядер. Каждый поток воркера держит своё соединение с базой
+(DB_CONN_MAX_AGE), так что воркеры × потоки не должны превышать
+max_connections Postgres.
+"""
+import os
+import shutil
+
+SERVER_MODE = os.getenv('SERVER_MODE', 'wsgi')
+# Воркеры пишут метрики в общий каталог, /metrics суммирует их.
+METRICS_DIR = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', '/tmp/foodgram_metrics'
+)
+# Учитывает ограничение контейнера по ядрам (cpuset).
+CPU_COUNT = len(os.sched_getaffinity(0))
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:8008')
+
+if SERVER_MODE == 'asgi':
+    wsgi_app = 'foodgram.asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+    # Воркер обслуживает запросы параллельно, хватает одного на ядро.
+    workers = int(os.getenv('GUNICORN_WORKERS', CPU_COUNT))
+else:
+    wsgi_app = 'foodgram.wsgi:application'
+    threads = int(os.getenv('GUNICORN_THREADS', 1))
+    worker_class = 'gthread' if threads > 1 else 'sync'
+    workers = int(os.getenv('GUNICORN_WORKERS', CPU_COUNT * 2 + 1))
+
+# Django загружается один раз в мастере, воркеры стартуют быстрее.
+preload_app = True
+# Воркер плавно перезапускается после max_requests запросов; разброс не
+# даёт всем воркерам перезапуститься одновременно.
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5
+# Файл heartbeat на overlayfs в Docker может тормозить воркеры.
+worker_tmp_dir = '/dev/shm'
+
+
+def on_starting(server):
+    """Метрики прошлого запуска сервера не учитываются."""
+    shutil.rmtree(METRICS_DIR, ignore_errors=True)
+    os.makedirs(METRICS_DIR)
+
+
+def worker_exit(server, worker):
+    """Воркер дожидается обработки поставленных изображений."""
+    from recipes.images import shutdown_executor
+
+    shutdown_executor()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def when_ready(server):
+    """Соединения, открытые мастером, не должны достаться воркерам."""
+    from django.db import connections
+
+    connections.close_all()
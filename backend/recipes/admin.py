@@ -6,6 +6,7 @@ from .models import (
     Recipe,
     RecipesIngredients,
     ShoppingCart,
+    ShoppingCartTotal,
     Tag
 )
 
@@ -43,15 +44,15 @@ class RecipeAdmin(admin.ModelAdmin):
     """Модель рецептов в админке."""
 
     inlines = [IngredientInRecipeInline]
-    list_display = ('id', 'name', 'author')
+    list_display = ('id', 'name', 'author', 'in_favorite')
     list_filter = ('name', 'author', 'tags')
     search_fields = ('name', 'author', 'tags')
 
     def in_favorite(self, obj):
-        count = obj.in_favorite.all().count()
-        return count
+        return obj.favorites_count
 
     in_favorite.short_description = "Количество добавлений в избранное."
+    in_favorite.admin_order_field = 'favorites_count'
 
 
 @admin.register(Favorite)
@@ -72,3 +73,24 @@ class ShoppingCartAdmin(admin.ModelAdmin):
 class RecipeIngredientAdmin(admin.ModelAdmin):
 
     list_display = ('recipe', 'ingredient', 'amount')
+
+
+@admin.register(ShoppingCartTotal)
+class ShoppingCartTotalAdmin(admin.ModelAdmin):
+    """Итоги списков покупок в админке, только для просмотра.
+
+    Итоги выводятся из списков покупок; исправляет их
+    rebuild_cart_totals.
+    """
+
+    list_display = ('user', 'ingredient', 'amount')
+    search_fields = ('user__username', 'ingredient__name')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
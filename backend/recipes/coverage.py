@@ -0,0 +1,234 @@
+import threading
+import time
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from .models import Recipe, RecipesIngredients
+from .versions import DELETED_RECIPES, RECIPES, get_version
+
+# Изменения, зафиксированные позже своей отметки updated_at, не теряются:
+# при синхронизации рецепты перечитываются с таким запасом.
+SYNC_LAG = timedelta(minutes=1)
+# Сколько изменённых рецептов держать поверх индекса до его перестройки.
+OVERLAY_LIMIT = 5000
+FETCH_SIZE = 100_000
+ID_BITS = 31
+COUNT_BITS = 10
+MAX_COUNT = (1 << COUNT_BITS) - 1
+MAX_ID = (1 << ID_BITS) - 1
+
+
+def fetch_rows(queryset, width):
+    """Строки values_list() двумерным массивом NumPy, кусками."""
+    query, params = queryset.query.sql_with_params()
+    chunks = [np.empty((0, width), np.int64)]
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            chunks.append(np.array(rows, dtype=np.int64))
+    return np.concatenate(chunks)
+
+
+def fetch_pairs(recipe_ids=None):
+    """Пары (рецепт, ингредиент) массивами NumPy, без повторов."""
+    queryset = RecipesIngredients.objects.order_by()
+    if recipe_ids is not None:
+        queryset = queryset.filter(recipe_id__in=recipe_ids)
+    pairs = fetch_rows(
+        queryset.values_list('recipe_id', 'ingredient_id').distinct(), 2
+    )
+    return pairs[:, 0], pairs[:, 1]
+
+
+def fetch_recipe_ids():
+    """Отсортированные id всех существующих рецептов."""
+    return fetch_rows(
+        Recipe.objects.order_by('pk').values_list('pk'), 1
+    )[:, 0]
+
+
+class CoverageResult:
+    """Рецепты, отсортированные по покрытию набора ингредиентов.
+
+    Сначала идут рецепты с меньшим числом недостающих ингредиентов, затем
+    с большим числом совпавших, затем более новые. Для пагинатора это
+    последовательность: длина известна сразу, а сортируется только
+    префикс до запрошенной страницы.
+    """
+
+    def __init__(self, recipe_ids, matched, missing):
+        self.recipe_ids = recipe_ids
+        self.matched = matched
+        self.missing = missing
+        self.keys = (
+            np.minimum(missing, MAX_COUNT) << (COUNT_BITS + ID_BITS)
+            | (MAX_COUNT - np.minimum(matched, MAX_COUNT)) << ID_BITS
+            | (MAX_ID - recipe_ids)
+        )
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, index):
+        start, stop, _ = index.indices(len(self))
+        if start >= stop:
+            return []
+        top = np.arange(len(self))
+        if stop < len(self):
+            top = np.argpartition(self.keys, stop - 1)[:stop]
+        top = top[np.argsort(self.keys[top], kind='stable')][start:stop]
+        return list(zip(
+            self.recipe_ids[top].tolist(),
+            self.matched[top].tolist(),
+            self.missing[top].tolist(),
+        ))
+
+
+class CoverageIndex:
+    """Обратный индекс «ингредиент → рецепты» в формате CSR.
+
+    Рецепты, изменённые после построения, хранятся отдельно в overlay и
+    в основном индексе помечены как устаревшие; когда их становится
+    много или индекс стареет, он перестраивается целиком. Удалённые
+    рецепты тоже помечаются устаревшими и убираются из overlay.
+    """
+
+    def __init__(self, recipe_ids, ingredient_ids, version, deleted_version,
+                 built_at):
+        self.version = version
+        self.deleted_version = deleted_version
+        self.built_at = built_at
+        self.synced_at = built_at
+        self.created = time.monotonic()
+        self.recipe_ids = np.unique(recipe_ids)
+        positions = np.searchsorted(self.recipe_ids, recipe_ids)
+        order = np.argsort(ingredient_ids, kind='stable')
+        self.ingredient_ids, starts = np.unique(
+            ingredient_ids[order], return_index=True
+        )
+        self.indptr = np.append(starts, len(order))
+        self.positions = positions[order].astype(np.int32)
+        self.totals = np.bincount(positions, minlength=len(self.recipe_ids))
+        self.stale = np.zeros(len(self.recipe_ids), dtype=bool)
+        self.overlay = {}
+
+    @classmethod
+    def build(cls):
+        version = get_version(RECIPES)
+        deleted_version = get_version(DELETED_RECIPES)
+        built_at = timezone.now()
+        return cls(*fetch_pairs(), version, deleted_version, built_at)
+
+    @property
+    def expired(self):
+        return (
+            len(self.overlay) > OVERLAY_LIMIT
+            or time.monotonic() - self.created
+            > settings.COVERAGE_INDEX_MAX_AGE
+        )
+
+    def sync(self, version):
+        """Перечитывает рецепты, изменённые с прошлой синхронизации."""
+        synced_at = timezone.now()
+        changed = list(Recipe.objects.filter(
+            updated_at__gte=self.synced_at - SYNC_LAG
+        ).values_list('pk', flat=True))
+        ingredients = {pk: set() for pk in changed}
+        for recipe_id, ingredient_id in zip(*fetch_pairs(changed)):
+            ingredients[int(recipe_id)].add(int(ingredient_id))
+        self.overlay.update(ingredients)
+        self.stale |= np.isin(self.recipe_ids, changed)
+        deleted_version = get_version(DELETED_RECIPES)
+        if deleted_version != self.deleted_version:
+            self.drop_deleted()
+            self.deleted_version = deleted_version
+        self.synced_at = synced_at
+        self.version = version
+
+    def drop_deleted(self):
+        """Убирает рецепты, которых больше нет в базе.
+
+        Удаления редки, поэтому список id перечитывается целиком только
+        при смене их версии.
+        """
+        existing = fetch_recipe_ids()
+        self.stale |= ~np.isin(self.recipe_ids, existing, assume_unique=True)
+        overlay_ids = np.fromiter(self.overlay, np.int64, len(self.overlay))
+        for recipe_id in overlay_ids[~np.isin(overlay_ids, existing)]:
+            del self.overlay[int(recipe_id)]
+
+    def rank(self, ingredients, max_missing=None):
+        """Ранжирует рецепты по покрытию набора ingredients."""
+        ingredients = np.unique(np.asarray(ingredients, dtype=np.int64))
+        found = np.searchsorted(self.ingredient_ids, ingredients)
+        found = found[found < len(self.ingredient_ids)]
+        found = found[np.isin(self.ingredient_ids[found], ingredients)]
+        matched = np.bincount(
+            np.concatenate([np.empty(0, np.int32)] + [
+                self.positions[self.indptr[i]:self.indptr[i + 1]]
+                for i in found
+            ]),
+            minlength=len(self.recipe_ids),
+        )
+        missing = self.totals - matched
+        mask = (matched > 0) & ~self.stale
+        if max_missing is not None:
+            mask &= missing <= max_missing
+
+        wanted = set(ingredients.tolist())
+        extra = np.array([
+            (recipe_id, len(items & wanted), len(items - wanted))
+            for recipe_id, items in self.overlay.items()
+            if items & wanted and (
+                max_missing is None or len(items - wanted) <= max_missing
+            )
+        ], dtype=np.int64).reshape(-1, 3)
+        return CoverageResult(
+            np.concatenate([self.recipe_ids[mask], extra[:, 0]]),
+            np.concatenate([matched[mask], extra[:, 1]]),
+            np.concatenate([missing[mask], extra[:, 2]]),
+        )
+
+
+class CoverageIndexHolder:
+    """Индекс покрытия, общий для потоков процесса.
+
+    Синхронизируется при смене версии рецептов; устаревший индекс
+    перестраивается в фоне, пока запросы обслуживает прежний.
+    """
+
+    def __init__(self):
+        self.index = None
+        self.lock = threading.Lock()
+        self.rebuilding = False
+
+    def rebuild(self):
+        try:
+            index = CoverageIndex.build()
+            with self.lock:
+                self.index = index
+        finally:
+            self.rebuilding = False
+            connection.close()
+
+    def rank(self, ingredients, max_missing=None):
+        with self.lock:
+            if self.index is None:
+                self.index = CoverageIndex.build()
+            version = get_version(RECIPES)
+            if self.index.version != version:
+                self.index.sync(version)
+            if self.index.expired and not self.rebuilding:
+                self.rebuilding = True
+                threading.Thread(target=self.rebuild, daemon=True).start()
+            return self.index.rank(ingredients, max_missing)
+
+
+coverage_index = CoverageIndexHolder()
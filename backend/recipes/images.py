@@ -0,0 +1,207 @@
+import atexit
+import logging
+import os
+import posixpath
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import get_context
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.dispatch import Signal
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+RENDITION_FORMATS = {
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'jpg', {
+        'quality': 82, 'optimize': True, 'progressive': True
+    }),
+}
+
+# Отправляется, когда уменьшенные копии записаны в базу.
+renditions_ready = Signal()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def renditions_field(field_name):
+    return f'{field_name}_renditions'
+
+
+def get_renditions_dir(name):
+    """Каталог копий: renditions/<каталог оригинала>/<имя без расширения>."""
+    return posixpath.join(
+        settings.IMAGE_RENDITIONS_DIR, posixpath.splitext(name)[0]
+    )
+
+
+def _save_atomic(image, path, format, **params):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            image.save(file, format=format, **params)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def render_image(source_path, target_dir, widths, formats):
+    """Обрабатывает изображение в отдельном процессе.
+
+    Пишет копии заданных ширин в target_dir. Оригинал не изменяется, а в
+    копиях остаётся только цветовой профиль: EXIF (геометка, модель
+    камеры и т. п.) в них не попадает. Возвращает {ширина: {формат: имя
+    файла}}. Функция не использует Django, чтобы её можно было выполнять
+    в пуле процессов.
+    """
+    with Image.open(source_path) as original:
+        original.load()
+        icc_profile = original.info.get('icc_profile')
+        image = ImageOps.exif_transpose(original)
+
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    result = {}
+    for width in sorted({min(width, image.width) for width in widths}):
+        height = max(1, round(image.height * width / image.width))
+        resized = image.resize((width, height), Image.LANCZOS)
+        result[str(width)] = {}
+        for name in formats:
+            format, extension, params = RENDITION_FORMATS[name]
+            rendition = resized
+            if format == 'JPEG' and rendition.mode != 'RGB':
+                rendition = rendition.convert('RGB')
+            filename = f'{width}.{extension}'
+            _save_atomic(
+                rendition, os.path.join(target_dir, filename), format,
+                icc_profile=icc_profile, **params
+            )
+            result[str(width)][name] = filename
+    return result
+
+
+def get_executor():
+    """Пул процессов создаётся лениво, отдельно в каждом воркере."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.IMAGE_PROCESSING_WORKERS,
+                mp_context=get_context('spawn'),
+            )
+    return _executor
+
+
+def shutdown_executor():
+    """Дожидается обработки поставленных изображений и закрывает пул.
+
+    Вызывается при выходе воркера gunicorn (worker_exit), а для других
+    серверов — при завершении интерпретатора.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+
+
+atexit.register(shutdown_executor)
+
+
+def rendition_paths(renditions):
+    return {
+        path
+        for files in renditions.get('widths', {}).values()
+        for path in files.values()
+    }
+
+
+def delete_files(paths):
+    for path in paths:
+        try:
+            default_storage.delete(path)
+        except OSError:
+            logger.exception('Не удалось удалить копию %s', path)
+
+
+def save_renditions(model, pk, field_name, name, widths):
+    """Записывает копии, только если изображение с тех пор не сменилось.
+
+    Файлы прежних копий, которые не переиспользуются, удаляются после
+    фиксации транзакции.
+    """
+    directory = get_renditions_dir(name)
+    renditions = {
+        'source': name,
+        'widths': {
+            width: {
+                format: posixpath.join(directory, filename)
+                for format, filename in files.items()
+            }
+            for width, files in widths.items()
+        },
+    }
+    with transaction.atomic():
+        previous = model.objects.select_for_update().filter(
+            pk=pk, **{field_name: name}
+        ).values_list(renditions_field(field_name), flat=True).first()
+        if previous is None:
+            return
+        model.objects.filter(pk=pk).update(
+            **{renditions_field(field_name): renditions}
+        )
+        transaction.on_commit(partial(
+            delete_files,
+            rendition_paths(previous) - rendition_paths(renditions),
+        ))
+    renditions_ready.send(sender=model, pk=pk, field_name=field_name)
+
+
+def _on_rendered(model, pk, field_name, name, future):
+    try:
+        widths = future.result()
+    except Exception:
+        logger.exception('Не удалось обработать изображение %s', name)
+        return
+    # Колбэк выполняется в служебном потоке пула со своим соединением.
+    close_old_connections()
+    save_renditions(model, pk, field_name, name, widths)
+
+
+def process_image(model, pk, field_name, name, sync=False):
+    """Строит копии изображения в пуле процессов или сразу, если sync."""
+    args = (
+        default_storage.path(name),
+        default_storage.path(get_renditions_dir(name)),
+        settings.IMAGE_RENDITION_WIDTHS,
+        settings.IMAGE_RENDITION_FORMATS,
+    )
+    if sync or not settings.IMAGE_PROCESSING_WORKERS:
+        save_renditions(model, pk, field_name, name, render_image(*args))
+        return
+    get_executor().submit(render_image, *args).add_done_callback(
+        partial(_on_rendered, model, pk, field_name, name)
+    )
+
+
+def needs_renditions(instance, field_name):
+    image = getattr(instance, field_name)
+    renditions = getattr(instance, renditions_field(field_name))
+    return bool(image) and renditions.get('source') != image.name
+
+
+def schedule_renditions(instance, field_name):
+    """Ставит изображение в очередь после фиксации транзакции."""
+    transaction.on_commit(partial(
+        process_image, type(instance), instance.pk, field_name,
+        getattr(instance, field_name).name,
+    ))
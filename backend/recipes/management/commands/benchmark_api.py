@@ -0,0 +1,343 @@
+import json
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client, TestCase
+from django.test.utils import override_settings
+from django.urls import NoReverseMatch, reverse
+from rest_framework.authtoken.models import Token
+
+from recipes.images import shutdown_executor
+from recipes.management.utils import percentile
+from recipes.models import Favorite, ShoppingCart
+from recipes.seeding import Seeder, sample_image
+from recipes.versions import FAVORITES, RECIPES, REFERENCE, bump_version
+from users.models import Subscribe
+
+PREFIX = 'apibench'
+WORKLOADS = (
+    'anon_browse',
+    'auth_browse',
+    'subscriptions',
+    'favorite_cart',
+    'shopping_list',
+    'recipe_write',
+)
+# Наибольшее число SQL-запросов на шаг чтения. Оно не зависит от размера
+# страницы, поэтому превышение означает N+1.
+QUERY_BUDGETS = {
+    'anon_browse: список рецептов': 5,
+    'anon_browse: рецепт': 5,
+    'auth_browse: рецепты по тегам': 10,
+    'auth_browse: рецепт': 9,
+    'subscriptions: подписки': 4,
+    'subscriptions: подписки без лимита': 4,
+    'subscriptions: лента': 10,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Замеряет API через настоящий URLconf на сгенерированных данных: '
+        'p50/p99, запросы в секунду и SQL-запросы на запрос по шагам '
+        'сценариев. Данные создаются в транзакции и откатываются. '
+        'Результат можно сохранить как базовый и сравнивать с ним.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--recipes', type=int, default=2000)
+        parser.add_argument(
+            '--active-users', type=int, default=20,
+            help='Сколько пользователей выполняют сценарии.',
+        )
+        parser.add_argument(
+            '--iterations', type=int, default=50,
+            help='Повторов каждого сценария.',
+        )
+        parser.add_argument('--warmup', type=int, default=3)
+        parser.add_argument(
+            '--workload', action='append', choices=WORKLOADS,
+            help='Запустить только эти сценарии.',
+        )
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--baseline', help='JSON с базовыми результатами для сравнения.'
+        )
+        parser.add_argument(
+            '--save-baseline', help='Сохранить результаты в этот JSON.'
+        )
+        parser.add_argument(
+            '--tolerance', type=float, default=0.25,
+            help='Допустимый рост p99 относительно базового.',
+        )
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.stats = defaultdict(lambda: {'timings': [], 'queries': []})
+        self.errors = defaultdict(int)
+        media_root = tempfile.mkdtemp(prefix=PREFIX)
+        try:
+            with override_settings(MEDIA_ROOT=media_root), \
+                    transaction.atomic():
+                self.prepare(options)
+                self.run(options)
+                transaction.set_rollback(True)
+        finally:
+            # Кэш мог запомнить откаченные данные под текущими версиями.
+            bump_version(RECIPES, REFERENCE, FAVORITES)
+            shutdown_executor()
+            shutil.rmtree(media_root, ignore_errors=True)
+        results = self.results()
+        self.report(results, options)
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as file:
+                json.dump(results, file, ensure_ascii=False, indent=2)
+
+    def prepare(self, options):
+        started = time.perf_counter()
+        seeder = Seeder(PREFIX, options['seed']).seed(
+            options['users'], options['recipes']
+        )
+        self.stdout.write(
+            f'Данные созданы за {time.perf_counter() - started:.1f} с: '
+            f'{len(seeder.user_ids)} пользователей, '
+            f'{len(seeder.recipe_ids)} рецептов.'
+        )
+        self.seeder = seeder
+        self.image = sample_image()
+        self.users = seeder.user_ids[:options['active_users']]
+        # Ошибка сервера засчитывается шагу, а не прерывает замер.
+        self.clients = {None: Client(
+            raise_request_exception=False, HTTP_HOST='localhost'
+        )}
+        for user_id in self.users:
+            token = Token.objects.create(user_id=user_id)
+            self.clients[user_id] = Client(
+                raise_request_exception=False,
+                HTTP_HOST='localhost',
+                HTTP_AUTHORIZATION=f'Token {token.key}',
+            )
+        self.favorites = self.related_ids(Favorite, 'recipe')
+        self.cart = self.related_ids(ShoppingCart, 'recipe')
+        self.follows = self.related_ids(Subscribe, 'author')
+
+    def related_ids(self, model, field):
+        related = defaultdict(set)
+        for user_id, target in model.objects.filter(
+            user_id__in=self.users
+        ).values_list('user_id', f'{field}_id'):
+            related[user_id].add(target)
+        return related
+
+    def run(self, options):
+        for name in options['workload'] or WORKLOADS:
+            workload = getattr(self, name)
+            self.recording = False
+            for _ in range(options['warmup']):
+                workload()
+            self.recording = True
+            for _ in range(options['iterations']):
+                workload()
+
+    def request(self, step, method, url, user=None, data=None):
+        """Выполняет запрос вместе с колбэками on_commit, как в автокоммите."""
+        client = self.clients[user]
+        kwargs = {}
+        if data is not None:
+            kwargs = {
+                'data': json.dumps(data), 'content_type': 'application/json'
+            }
+        queries = 0
+
+        def count(execute, *args):
+            nonlocal queries
+            queries += 1
+            return execute(*args)
+
+        started = time.perf_counter()
+        with connection.execute_wrapper(count), \
+                TestCase.captureOnCommitCallbacks(execute=True):
+            response = getattr(client, method)(url, **kwargs)
+            if response.streaming:
+                # Клиент закрывает потоковый ответ по окончании чтения.
+                b''.join(response.streaming_content)
+        elapsed = (time.perf_counter() - started) * 1000
+        if self.recording:
+            stats = self.stats[step]
+            stats['timings'].append(elapsed)
+            stats['queries'].append(queries)
+            if response.status_code >= 400:
+                self.errors[step] += 1
+        return response
+
+    def user(self):
+        return self.random.choice(self.users)
+
+    def recipe(self, exclude=()):
+        while True:
+            recipe_id = self.random.choice(self.seeder.recipe_ids)
+            if recipe_id not in exclude:
+                return recipe_id
+
+    def anon_browse(self):
+        pages = max(1, len(self.seeder.recipe_ids) // 6)
+        self.request(
+            'anon_browse: список рецептов', 'get',
+            reverse('recipes-list')
+            + f'?page={self.random.randint(1, min(pages, 20))}',
+        )
+        self.request(
+            'anon_browse: рецепт', 'get',
+            reverse('recipes-detail', args=[self.recipe()]),
+        )
+        self.request('anon_browse: теги', 'get', reverse('tags-list'))
+        self.request(
+            'anon_browse: поиск ингредиента', 'get',
+            reverse('ingredients-list') + f'?name={PREFIX[:3]}',
+        )
+
+    def auth_browse(self):
+        user = self.user()
+        tags = self.random.sample(self.seeder.tags, 2)
+        self.request(
+            'auth_browse: рецепты по тегам', 'get',
+            reverse('recipes-list') + '?' + '&'.join(
+                f'tags={tag.slug}' for tag in tags
+            ),
+            user,
+        )
+        self.request(
+            'auth_browse: рецепт', 'get',
+            reverse('recipes-detail', args=[self.recipe()]), user,
+        )
+        self.request('auth_browse: профиль', 'get', reverse('users-me'), user)
+
+    def subscriptions(self):
+        user = self.user()
+        self.request(
+            'subscriptions: подписки', 'get',
+            reverse('users-subscriptions') + '?recipes_limit=3', user,
+        )
+        self.request(
+            'subscriptions: подписки без лимита', 'get',
+            reverse('users-subscriptions'), user,
+        )
+        self.request('subscriptions: лента', 'get', reverse('recipes-feed'),
+                     user)
+        author = self.random.choice(self.seeder.user_ids)
+        if author == user or author in self.follows[user]:
+            return
+        url = reverse('users-subscribe', args=[author])
+        self.request('subscriptions: подписаться', 'post', url, user)
+        self.request('subscriptions: отписаться', 'delete', url, user)
+
+    def favorite_cart(self):
+        user = self.user()
+        toggles = (('favorite', 'recipes-favorite', self.favorites),
+                   ('cart', 'recipes-shopping-cart', self.cart))
+        for name, url_name, existing in toggles:
+            try:
+                url = reverse(url_name, args=[self.recipe(existing[user])])
+            except NoReverseMatch:
+                continue
+            self.request(f'favorite_cart: {name} +', 'post', url, user)
+            self.request(f'favorite_cart: {name} -', 'delete', url, user)
+
+    def shopping_list(self):
+        user = self.user()
+        url = reverse('recipes-download-shopping-cart')
+        for file_format in ('txt', 'pdf'):
+            self.request(
+                f'shopping_list: {file_format}', 'get',
+                f'{url}?file_format={file_format}', user,
+            )
+
+    def recipe_write(self):
+        user = self.user()
+        data = {
+            'name': f'{PREFIX} новый рецепт',
+            'text': 'Описание',
+            'cooking_time': self.random.randint(5, 120),
+            'image': self.image,
+            'tags': [
+                tag.pk for tag in self.random.sample(self.seeder.tags, 2)
+            ],
+            'ingredients': [
+                {'id': ingredient_id, 'amount': self.random.randint(1, 500)}
+                for ingredient_id in self.random.sample(
+                    self.seeder.ingredient_ids, 10
+                )
+            ],
+        }
+        response = self.request(
+            'recipe_write: создание', 'post', reverse('recipes-list'), user,
+            data,
+        )
+        if response.status_code != 201:
+            return
+        data['ingredients'] = data['ingredients'][2:] + [
+            {'id': ingredient['id'], 'amount': ingredient['amount'] + 1}
+            for ingredient in data['ingredients'][:2]
+        ]
+        del data['image']
+        self.request(
+            'recipe_write: изменение', 'patch',
+            reverse('recipes-detail', args=[response.json()['id']]), user,
+            data,
+        )
+
+    def results(self):
+        results = {}
+        for step, stats in self.stats.items():
+            timings = sorted(stats['timings'])
+            results[step] = {
+                'requests': len(timings),
+                'errors': self.errors[step],
+                'p50': round(statistics.median(timings), 2),
+                'p99': round(percentile(timings, 0.99), 2),
+                'rps': round(len(timings) / sum(timings) * 1000, 1),
+                'queries': round(statistics.mean(stats['queries']), 1),
+                'max_queries': max(stats['queries']),
+            }
+        return results
+
+    def report(self, results, options):
+        baseline = {}
+        if options['baseline']:
+            with open(options['baseline']) as file:
+                baseline = json.load(file)
+        self.stdout.write(
+            f'{"шаг":<40}{"ошибок":>7}{"p50, мс":>9}{"p99, мс":>9}'
+            f'{"в сек.":>8}{"SQL":>7}'
+            + (f'{"p99 к базе":>12}{"SQL к базе":>12}' if baseline else '')
+        )
+        regressions = []
+        for step, result in results.items():
+            budget = QUERY_BUDGETS.get(step)
+            if budget is not None and result['max_queries'] > budget:
+                regressions.append(f'{step} (SQL > {budget})')
+            line = (
+                f'{step:<40}{result["errors"]:>7}{result["p50"]:>9.1f}'
+                f'{result["p99"]:>9.1f}{result["rps"]:>8.1f}'
+                f'{result["queries"]:>7.1f}'
+            )
+            base = baseline.get(step)
+            if base:
+                change = result['p99'] / base['p99'] - 1
+                queries = result['queries'] - base['queries']
+                line += f'{change:>+12.0%}{queries:>+12.1f}'
+                if change > options['tolerance'] or queries > 0:
+                    regressions.append(step)
+            self.stdout.write(line)
+        if regressions:
+            raise CommandError(
+                'Хуже базовых результатов или бюджета SQL: '
+                + ', '.join(regressions)
+            )
@@ -0,0 +1,204 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.test.utils import override_settings
+
+from api.paginators import keyset_filter
+from api.services import FEED_ORDERING, get_feed
+from recipes.management.utils import batched
+from recipes.models import FeedEntry, Recipe
+from users.models import Subscribe, User
+
+BATCH_SIZE = 5000
+PREFIX = 'feedbench'
+
+
+def measure(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.95)]
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает ленту подписок с раздачей при публикации (fan-out) и '
+        'сборкой при чтении (fan-in) на сгенерированных данных. Данные '
+        'создаются в транзакции и по окончании откатываются.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--authors', type=int, default=500)
+        parser.add_argument('--readers', type=int, default=2000)
+        parser.add_argument(
+            '--follows', type=int, default=100,
+            help='Сколько авторов читает каждый читатель.',
+        )
+        parser.add_argument('--recipes', type=int, default=50000)
+        parser.add_argument(
+            '--celebrities', type=int, default=5,
+            help='Авторы, на которых подписаны все читатели.',
+        )
+        parser.add_argument('--page-size', type=int, default=6)
+        parser.add_argument(
+            '--depth', type=int, default=10,
+            help='Номер страницы для замера глубокой прокрутки.',
+        )
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        with transaction.atomic():
+            readers = self.generate(options)
+            self.report(options, readers)
+            transaction.set_rollback(True)
+
+    def generate(self, options):
+        started = time.perf_counter()
+        User.objects.bulk_create(
+            User(
+                username=f'{PREFIX}{number}',
+                email=f'{PREFIX}{number}@example.com',
+                first_name=PREFIX,
+                last_name=PREFIX,
+            )
+            for number in range(options['authors'] + options['readers'])
+        )
+        # Не все базы возвращают первичные ключи из bulk_create.
+        users = list(
+            User.objects.filter(username__startswith=PREFIX).order_by('pk')
+        )
+        authors = users[:options['authors']]
+        readers = users[options['authors']:]
+        celebrities = authors[:options['celebrities']]
+        regular = authors[options['celebrities']:]
+        follows = options['follows'] - len(celebrities)
+        Subscribe.objects.bulk_create(
+            (
+                Subscribe(user=reader, author=author)
+                for reader in readers
+                for author in celebrities + self.random.sample(
+                    regular, min(follows, len(regular))
+                )
+            ),
+            batch_size=BATCH_SIZE,
+        )
+        User.objects.filter(pk__in=[author.pk for author in authors]).update(
+            followers_count=Coalesce(Subquery(
+                Subscribe.objects.filter(
+                    author=OuterRef('pk')
+                ).order_by().values('author').annotate(
+                    total=Count('id')
+                ).values('total')
+            ), 0)
+        )
+        Recipe.objects.bulk_create(
+            (
+                Recipe(
+                    author=self.random.choice(authors),
+                    name=f'{PREFIX} {number}',
+                    image='recipe_images/benchmark.png',
+                    text=PREFIX,
+                    cooking_time=1,
+                )
+                for number in range(options['recipes'])
+            ),
+            batch_size=BATCH_SIZE,
+        )
+        recipe_ids = list(Recipe.objects.filter(
+            author__username__startswith=PREFIX
+        ).values_list('pk', flat=True))
+        self.stdout.write(
+            f'Данные созданы за {time.perf_counter() - started:.1f} с: '
+            f'{len(authors)} авторов, {len(readers)} читателей, '
+            f'{len(recipe_ids)} рецептов.'
+        )
+        self.recipe_ids = recipe_ids
+        return readers
+
+    def fan_out(self, limit):
+        """Раскладывает все рецепты по лентам.
+
+        Возвращает время записи и число строк ленты в расчёте на рецепт.
+        """
+        FeedEntry.objects.filter(recipe_id__in=self.recipe_ids).delete()
+        started = time.perf_counter()
+        with override_settings(FEED_FANOUT_LIMIT=limit):
+            for batch in batched(self.recipe_ids, BATCH_SIZE):
+                FeedEntry.objects.fan_out(batch)
+        elapsed = (time.perf_counter() - started) * 1000
+        rows = FeedEntry.objects.filter(recipe_id__in=self.recipe_ids).count()
+        return elapsed / len(self.recipe_ids), rows / len(self.recipe_ids)
+
+    def read_fan_in(self, reader, after, limit):
+        recipes = Recipe.objects.filter(
+            author__following_author__user=reader
+        ).order_by(*FEED_ORDERING)
+        if after is not None:
+            recipes = recipes.filter(keyset_filter(FEED_ORDERING, after))
+        return list(recipes.only('id', 'pub_date')[:limit])
+
+    def read_feed(self, reader, after, limit):
+        return get_feed(reader, Recipe.objects.only('id', 'pub_date'),
+                        after, limit)
+
+    def cursor_at(self, read, reader, options):
+        """Ключ последнего рецепта перед страницей --depth."""
+        skip = (options['depth'] - 1) * options['page_size']
+        if not skip:
+            return None
+        recipes = read(reader, None, skip)
+        if len(recipes) < skip:
+            return None
+        return [recipes[-1].pub_date, recipes[-1].id]
+
+    def bench_reads(self, read, readers, options):
+        sample = self.random.sample(readers, min(20, len(readers)))
+        deep = {
+            reader.pk: self.cursor_at(read, reader, options)
+            for reader in sample
+        }
+        page_size = options['page_size']
+        repeat = options['repeat']
+        first = measure(
+            lambda: read(self.random.choice(sample), None, page_size), repeat
+        )
+
+        def read_deep():
+            reader = self.random.choice(sample)
+            read(reader, deep[reader.pk], page_size)
+
+        return first, measure(read_deep, repeat)
+
+    def report(self, options, readers):
+        celebrity_followers = len(readers)
+        strategies = (
+            ('fan-in', None, self.read_fan_in),
+            ('fan-out', celebrity_followers, self.read_feed),
+            ('гибрид', celebrity_followers - 1, self.read_feed),
+        )
+        self.stdout.write(
+            f'{"стратегия":<10}{"запись, мс/рецепт":>20}'
+            f'{"строк/рецепт":>15}{"стр. 1 p50/p95, мс":>22}'
+            f'{"стр. " + str(options["depth"]) + " p50/p95, мс":>24}'
+        )
+        for name, limit, read in strategies:
+            write_ms, rows = 0.0, 0.0
+            if limit is not None:
+                write_ms, rows = self.fan_out(limit)
+            with override_settings(FEED_FANOUT_LIMIT=limit or 0):
+                first, deep = self.bench_reads(read, readers, options)
+            self.stdout.write(
+                f'{name:<10}{write_ms:>20.3f}{rows:>15.1f}'
+                f'{first[0]:>11.2f}/{first[1]:<10.2f}'
+                f'{deep[0]:>12.2f}/{deep[1]:<11.2f}'
+            )
@@ -0,0 +1,63 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+
+from recipes.models import Recipe, Tag
+from recipes.seeding import Seeder
+from recipes.versions import FAVORITES, RECIPES, REFERENCE, bump_version
+from users.models import User
+
+PREFIXES = ('checka', 'checkb')
+
+
+class Command(BaseCommand):
+    help = (
+        'Проверяет, что генераторы данных с разными префиксами и одним '
+        '--seed уживаются в одной базе: так benchmark_api и '
+        'explain_endpoints запускаются поверх данных seed_scale. Данные '
+        'создаются в транзакции и откатываются.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--recipes', type=int, default=200)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                seeders = [
+                    Seeder(prefix, options['seed']).seed(
+                        options['users'], options['recipes'], feed=False
+                    )
+                    for prefix in PREFIXES
+                ]
+                self.verify(seeders, options)
+                transaction.set_rollback(True)
+        except RuntimeError as error:
+            raise CommandError(error)
+        finally:
+            bump_version(RECIPES, REFERENCE, FAVORITES)
+        self.stdout.write(self.style.SUCCESS(
+            f'Префиксы {", ".join(PREFIXES)} уживаются в одной базе.'
+        ))
+
+    def verify(self, seeders, options):
+        first, second = seeders
+        if set(first.user_ids) & set(second.user_ids) or set(
+            first.recipe_ids
+        ) & set(second.recipe_ids):
+            raise CommandError('Диапазоны id генераторов пересекаются.')
+        for seeder in seeders:
+            users = User.objects.filter(pk__in=seeder.user_ids).count()
+            recipes = Recipe.objects.filter(pk__in=seeder.recipe_ids).count()
+            if (users, recipes) != (options['users'], options['recipes']):
+                raise CommandError(
+                    f'{seeder.prefix}: создано {users} пользователей и '
+                    f'{recipes} рецептов.'
+                )
+        duplicates = Tag.objects.values('color').annotate(
+            total=Count('id')
+        ).filter(total__gt=1)
+        if duplicates.exists():
+            raise CommandError('У тегов совпадают цвета.')
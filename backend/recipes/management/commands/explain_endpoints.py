@@ -0,0 +1,500 @@
+import json
+import re
+import shutil
+import tempfile
+from collections import defaultdict
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test import Client, TestCase
+from django.test.utils import override_settings
+from django.urls import URLPattern, get_resolver, reverse
+from rest_framework.authtoken.models import Token
+
+from recipes.models import Favorite, Ingredient, Recipe, Tag
+from recipes.seeding import Seeder, sample_image
+from recipes.versions import FAVORITES, RECIPES, REFERENCE, bump_version
+from users.models import User
+
+PREFIX = 'explain'
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+# Варианты строки запроса для списков; {tag}, {author} и т. п.
+# подставляются из выбранных данных.
+QUERIES = {
+    'recipes-list': (
+        '', '?page=20', '?tags={tag}', '?author={author}',
+        '?ordering=-favorites_count', '?search={word}',
+    ),
+    'recipes-by-ingredients': (
+        '?ingredients={ingredient}&ingredients={ingredient2}'
+        '&max_missing=3',
+    ),
+    'recipes-download-shopping-cart': ('?file_format=txt',),
+    'ingredients-list': ('?name={ingredient_prefix}',),
+    'users-list': ('', '?page=20'),
+    'users-subscriptions': ('?recipes_limit=3',),
+}
+# Записи, которые воспроизводятся: маршрут → [(метод, тело)].
+WRITES = {
+    'recipes-favorite': (('post', None), ('delete', None)),
+    'recipes-shopping-cart': (('post', None), ('delete', None)),
+    'users-subscribe': (('post', None), ('delete', None)),
+    'recipes-favorite-many': (('post', 'recipes'), ('delete', 'recipes')),
+    'recipes-shopping-cart-many': (
+        ('post', 'recipes'), ('delete', 'recipes'),
+    ),
+    'recipes-list': (('post', 'recipe'),),
+    'recipes-detail': (('patch', 'recipe'),),
+}
+# Какой объект подставляется в путь: по умолчанию по префиксу маршрута,
+# для записей — ещё не связанный с пользователем или свой.
+PATH_SAMPLES = {
+    'recipes': 'recipe',
+    'users': 'author',
+    'tags': 'tag',
+    'ingredients': 'ingredient',
+}
+WRITE_SAMPLES = {
+    'recipes-favorite': 'new_recipe',
+    'recipes-shopping-cart': 'new_recipe',
+    'users-subscribe': 'new_author',
+    'recipes-detail': 'own_recipe',
+}
+
+
+def api_routes(patterns=None, prefix=''):
+    """Маршруты API без дублей и вариантов с расширением формата."""
+    if patterns is None:
+        patterns = get_resolver().url_patterns
+    for pattern in patterns:
+        route = prefix + str(pattern.pattern)
+        if not isinstance(pattern, URLPattern):
+            yield from api_routes(pattern.url_patterns, route)
+        elif (route.startswith('api/') and pattern.name
+                and 'format' not in pattern.pattern.regex.groupindex):
+            yield route, pattern
+
+
+def table_indexes():
+    """Индексы моделей: таблица → [(имя, столбцы)]."""
+    indexes = defaultdict(list)
+    for model in apps.get_models(include_auto_created=True):
+        meta = model._meta
+        fields = {field.name: field.column for field in meta.concrete_fields}
+        columns = indexes[meta.db_table]
+        for field in meta.concrete_fields:
+            if field.primary_key or field.unique or field.db_index:
+                columns.append((field.name, (field.column,)))
+        for index in meta.indexes:
+            columns.append((index.name, tuple(
+                fields[name.lstrip('-')] for name in index.fields
+            )))
+        for constraint in meta.constraints:
+            if getattr(constraint, 'fields', None):
+                columns.append((constraint.name, tuple(
+                    fields[name] for name in constraint.fields
+                )))
+        for unique in meta.unique_together:
+            columns.append(('unique_together', tuple(
+                fields[name] for name in unique
+            )))
+    return indexes
+
+
+def clause(sql, keyword, ends):
+    """Текст предложения верхнего уровня, грубо: до следующего ключевого."""
+    start = sql.find(f' {keyword} ')
+    if start < 0:
+        return ''
+    text = sql[start + len(keyword) + 2:]
+    for end in ends:
+        position = text.find(f' {end} ')
+        if position >= 0:
+            text = text[:position]
+    return text
+
+
+def suggest_columns(sql, table, sort=False):
+    """Столбцы индекса для таблицы: условия равенства, затем сортировка."""
+    quoted = re.escape(f'"{table}"')
+    where = clause(sql, 'WHERE', ('GROUP BY', 'ORDER BY', 'LIMIT'))
+    columns = re.findall(rf'{quoted}\."(\w+)"\s*(?:=|IN\b)', where)
+    if not columns and re.search(rf'JOIN {quoted}', sql):
+        # Присоединяемая таблица читается по столбцу из условия JOIN.
+        columns = re.findall(
+            rf'{quoted}\."(\w+)"', clause(sql, 'ON', ('WHERE',))
+        )[:1]
+    order = []
+    if sort:
+        ordering = clause(sql, 'ORDER BY', ('LIMIT', 'OFFSET'))
+        order = re.findall(rf'{quoted}\."(\w+)"\s*(ASC|DESC)?', ordering)
+        if len(order) != len(ordering.split(',')):
+            # Сортировка по столбцам других таблиц или по выражениям
+            # индексом этой таблицы не решается.
+            order = []
+    result = list(dict.fromkeys(columns))
+    for column, direction in order:
+        if column not in result:
+            result.append(('-' if direction == 'DESC' else '') + column)
+    return tuple(result)
+
+
+class Command(BaseCommand):
+    help = (
+        'Воспроизводит запросы ко всем маршрутам API и снимает план каждого '
+        'SQL-запроса: EXPLAIN (ANALYZE, BUFFERS) в PostgreSQL, EXPLAIN '
+        'QUERY PLAN в SQLite. Отмечает последовательное чтение и сортировку '
+        'больших таблиц и предлагает индексы. По умолчанию данные '
+        'создаются в транзакции и откатываются; --no-seed берёт данные '
+        'из базы, например после seed_scale.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--recipes', type=int, default=20000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--no-seed', action='store_true',
+            help='Не создавать данные, а использовать уже имеющиеся.',
+        )
+        parser.add_argument(
+            '--min-rows', type=int, default=10000,
+            help='С какого числа строк таблица считается большой.',
+        )
+        parser.add_argument(
+            '--route', action='append',
+            help='Только маршруты с этими именами, например recipes-list.',
+        )
+        parser.add_argument(
+            '--output', help='Сохранить все запросы и планы в этот JSON.'
+        )
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.postgres = connection.vendor == 'postgresql'
+        self.indexes = table_indexes()
+        self.sizes = {}
+        self.captured = []
+        self.proposals = defaultdict(set)
+        self.skipped = []
+        media_root = tempfile.mkdtemp(prefix=PREFIX)
+        try:
+            with override_settings(
+                MEDIA_ROOT=media_root, IMAGE_PROCESSING_WORKERS=0
+            ), transaction.atomic():
+                if not options['no_seed']:
+                    Seeder(PREFIX, options['seed']).seed(
+                        options['users'], options['recipes']
+                    )
+                self.prepare()
+                self.replay()
+                transaction.set_rollback(True)
+        finally:
+            bump_version(RECIPES, REFERENCE, FAVORITES)
+            shutil.rmtree(media_root, ignore_errors=True)
+        self.report()
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                json.dump(
+                    self.captured, file, ensure_ascii=False, indent=2,
+                    default=str,
+                )
+
+    def prepare(self):
+        """Выбирает активного пользователя и объекты для запросов."""
+        user_id = Favorite.objects.values('user').annotate(
+            total=Count('id')
+        ).order_by('-total').values_list('user', flat=True).first()
+        user = User.objects.get(pk=user_id) if user_id else (
+            User.objects.filter(is_active=True).order_by('pk').first()
+        )
+        recipe = Recipe.objects.order_by('-favorites_count', 'pk').first()
+        ingredients = list(Ingredient.objects.order_by('pk')[:2])
+        fresh = Recipe.objects.exclude(
+            in_favorites__user=user
+        ).exclude(shopping_cart__user=user).order_by('-pk')
+        new_recipes = list(fresh.values_list('pk', flat=True)[:5])
+        new_author = User.objects.exclude(pk=user.pk).exclude(
+            following_author__user=user
+        ).order_by('-followers_count').first()
+        own_recipe = Recipe.objects.filter(author=user).first() or recipe
+        tags = list(Tag.objects.order_by('pk')[:2])
+        self.client = Client(
+            raise_request_exception=False, HTTP_HOST='localhost',
+            HTTP_AUTHORIZATION=(
+                f'Token {Token.objects.get_or_create(user=user)[0].key}'
+            ),
+        )
+        self.samples = {
+            'recipe': recipe.pk,
+            'author': recipe.author_id,
+            'tag': tags[0].pk,
+            'ingredient': ingredients[0].pk,
+            'new_recipe': new_recipes[0],
+            'new_author': new_author.pk,
+            'own_recipe': own_recipe.pk,
+        }
+        self.values = {
+            'tag': tags[0].slug,
+            'author': recipe.author_id,
+            'word': recipe.name.split()[0],
+            'ingredient': ingredients[0].pk,
+            'ingredient2': ingredients[-1].pk,
+            'ingredient_prefix': ingredients[0].name[:3],
+        }
+        self.payloads = {
+            'recipes': {'recipes': new_recipes},
+            'recipe': {
+                'name': f'{PREFIX} рецепт',
+                'text': 'Описание',
+                'cooking_time': 30,
+                'image': sample_image(),
+                'tags': [tag.pk for tag in tags],
+                'ingredients': [
+                    {'id': ingredient.pk, 'amount': 100}
+                    for ingredient in ingredients
+                ],
+            },
+        }
+        self.stdout.write(
+            f'Пользователь {user.pk}, рецепт {recipe.pk}, '
+            f'автор для подписки {new_author.pk}.'
+        )
+
+    def url_for(self, name, pattern, sample):
+        return reverse(name, kwargs={
+            key: self.samples[sample]
+            for key in pattern.pattern.regex.groupindex
+        })
+
+    def requests_for(self, name, pattern):
+        """Запросы, которыми воспроизводится маршрут."""
+        actions = getattr(pattern.callback, 'actions', None) or {}
+        sample = PATH_SAMPLES.get(name.split('-')[0])
+        requests = []
+        if 'get' in actions:
+            url = self.url_for(name, pattern, sample)
+            requests += [
+                ('get', url + query.format(**self.values), None)
+                for query in QUERIES.get(name, ('',))
+            ]
+        for method, payload in WRITES.get(name, ()):
+            if method in actions:
+                requests.append((
+                    method,
+                    self.url_for(name, pattern, WRITE_SAMPLES.get(
+                        name, sample
+                    )),
+                    self.payloads.get(payload),
+                ))
+        return requests
+
+    def replay(self):
+        routes = {}
+        for route, pattern in api_routes():
+            routes.setdefault(route, pattern)
+        for route, pattern in routes.items():
+            name = pattern.name
+            if self.options['route'] and name not in self.options['route']:
+                continue
+            requests = self.requests_for(name, pattern)
+            if not requests:
+                self.skipped.append(name)
+            for method, url, data in requests:
+                self.replay_request(name, method, url, data)
+
+    def replay_request(self, name, method, url, data):
+        """Выполняет запрос, запоминая SQL, и снимает планы после него.
+
+        Планы снимаются после ответа, а не по ходу: EXPLAIN ANALYZE
+        выполняет запрос, и запись не должна повториться до ответа.
+        """
+        statements = []
+
+        def capture(execute, sql, params, many, context):
+            if not many:
+                statements.append((sql, params))
+            return execute(sql, params, many, context)
+
+        kwargs = {}
+        if data is not None:
+            kwargs = {'data': json.dumps(data),
+                      'content_type': 'application/json'}
+        with connection.execute_wrapper(capture), \
+                TestCase.captureOnCommitCallbacks(execute=True):
+            response = getattr(self.client, method)(url, **kwargs)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        line = (
+            f'{method.upper():6} {url} → {response.status_code}: '
+            f'{len(statements)} SQL'
+        )
+        problems, total_time = self.analyze(name, method, url, statements)
+        if self.postgres:
+            line += f', {total_time:.1f} мс'
+        self.stdout.write(line)
+        for problem in problems:
+            self.stdout.write(self.style.WARNING(f'    {problem}'))
+
+    def analyze(self, name, method, url, statements):
+        problems = {}
+        total_time = 0.0
+        for sql, params in statements:
+            if not sql.lstrip().upper().startswith(EXPLAINABLE):
+                continue
+            plan, time, flags = self.explain(sql, params)
+            total_time += time
+            self.captured.append({
+                'route': name, 'method': method.upper(), 'url': url,
+                'sql': sql, 'params': params, 'plan': plan,
+                'problems': [problem for problem, _ in flags],
+            })
+            for problem, proposal in flags:
+                problems[problem] = True
+                if proposal:
+                    self.proposals[proposal].add(name)
+        return list(problems), total_time
+
+    def explain(self, sql, params):
+        """План запроса в точке сохранения, которая затем откатывается."""
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                if self.postgres:
+                    cursor.execute(
+                        'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + sql,
+                        params,
+                    )
+                    plan = cursor.fetchone()[0][0]
+                else:
+                    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                    plan = [row[-1] for row in cursor.fetchall()]
+            transaction.set_rollback(True)
+        if self.postgres:
+            time = plan['Execution Time']
+            flags = self.postgres_flags(sql, plan['Plan'])
+        else:
+            time, flags = 0.0, self.sqlite_flags(sql, plan)
+        return plan, time, [flag for flag in flags if flag]
+
+    def table_size(self, table):
+        if table not in self.sizes:
+            with connection.cursor() as cursor:
+                if self.postgres:
+                    cursor.execute(
+                        'SELECT reltuples FROM pg_class WHERE relname = %s',
+                        [table],
+                    )
+                else:
+                    cursor.execute(
+                        'SELECT COUNT(*) FROM '
+                        + connection.ops.quote_name(table)
+                    )
+                row = cursor.fetchone()
+            self.sizes[table] = int(row[0]) if row else 0
+        return self.sizes[table]
+
+    def flag(self, kind, table, sql):
+        """Описание проблемы и предлагаемый индекс, если его ещё нет.
+
+        Сортировка по столбцам другой таблицы индексом не устраняется и
+        не отмечается.
+        """
+        columns = suggest_columns(sql, table, sort=kind == 'sort')
+        if kind == 'sort' and len(columns) == len(
+            suggest_columns(sql, table)
+        ):
+            return None
+        problem = (
+            f'{"сортировка" if kind == "sort" else "полное чтение"} '
+            f'{table} ({self.table_size(table)} строк)'
+        )
+        if not columns:
+            return problem, None
+        plain = tuple(column.lstrip('-') for column in columns)
+        for index_name, existing in self.indexes.get(table, ()):
+            if existing[:len(plain)] == plain:
+                return (
+                    f'{problem}: индекс {index_name} есть, но план его не '
+                    f'выбрал', None,
+                )
+        return f'{problem}: нужен индекс {columns}', (table, columns)
+
+    def postgres_flags(self, sql, node, flags=None):
+        flags = [] if flags is None else flags
+        children = node.get('Plans', ())
+        table = node.get('Relation Name')
+        if (node['Node Type'] == 'Seq Scan'
+                and self.table_size(table) >= self.options['min_rows']):
+            flags.append(self.flag('scan', table, sql))
+        if node['Node Type'] == 'Sort' and children:
+            source = self.scanned_table(children[0])
+            if source and self.table_size(source) >= self.options['min_rows']:
+                flags.append(self.flag('sort', source, sql))
+        for child in children:
+            self.postgres_flags(sql, child, flags)
+        return flags
+
+    def scanned_table(self, node):
+        if 'Relation Name' in node:
+            return node['Relation Name']
+        for child in node.get('Plans', ()):
+            table = self.scanned_table(child)
+            if table:
+                return table
+        return None
+
+    def sqlite_flags(self, sql, plan):
+        flags = []
+        tables = []
+        for detail in plan:
+            match = re.match(r'(SCAN|SEARCH) (\w+)', detail)
+            if not match:
+                continue
+            table = match.group(2)
+            if table not in self.indexes:
+                # Псевдоним подзапроса (U0 и т. п.), таблица неизвестна.
+                continue
+            tables.append(table)
+            if (match.group(1) == 'SCAN' and 'INDEX' not in detail
+                    and self.table_size(table) >= self.options['min_rows']):
+                flags.append(self.flag('scan', table, sql))
+        if any('TEMP B-TREE FOR ORDER BY' in detail for detail in plan):
+            large = [
+                table for table in tables
+                if self.table_size(table) >= self.options['min_rows']
+            ]
+            if large:
+                flags.append(self.flag('sort', large[0], sql))
+        return flags
+
+    def report(self):
+        if self.skipped:
+            self.stdout.write(
+                'Без воспроизводимых запросов: ' + ', '.join(self.skipped)
+            )
+        if not self.proposals:
+            self.stdout.write(self.style.SUCCESS('Новых индексов не нужно.'))
+            return
+        self.stdout.write('Предлагаемые индексы:')
+        models = {
+            model._meta.db_table: model
+            for model in apps.get_models(include_auto_created=True)
+        }
+        for (table, columns), routes in sorted(
+            self.proposals.items(), key=lambda item: -len(item[1])
+        ):
+            names = {
+                field.column: field.name
+                for field in models[table]._meta.concrete_fields
+            }
+            fields = [
+                ('-' if column.startswith('-') else '')
+                + names[column.lstrip('-')]
+                for column in columns
+            ]
+            self.stdout.write(
+                f'  {models[table].__name__}: models.Index(fields={fields})'
+                f' — {", ".join(sorted(routes))}'
+            )
@@ -0,0 +1,260 @@
+import csv
+import io
+import json
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from recipes.management.utils import batched
+from recipes.models import (
+    Ingredient,
+    Recipe,
+    RecipesIngredients,
+    Tag,
+    fold_search_name
+)
+from recipes.signals import bump_user_versions
+from recipes.versions import REFERENCE, bump_version
+from users.models import User
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def prepare_ingredient(row):
+    row['search_name'] = fold_search_name(row['name'])
+    return row
+
+
+# Модель, загружаемые поля, ключ для поиска дублей и подготовка строки.
+MODELS = {
+    'ingredient': (
+        Ingredient,
+        ('name', 'measurement_unit'),
+        'name',
+        prepare_ingredient,
+    ),
+    'tag': (
+        Tag,
+        ('name', 'color', 'slug'),
+        'slug',
+        None,
+    ),
+}
+
+
+def iter_csv(file, fields):
+    """Читает строки CSV без заголовка или с заголовком из имён полей."""
+    for values in csv.reader(file):
+        if not values or tuple(values) == fields:
+            continue
+        yield dict(zip(fields, values))
+
+
+def iter_json(file):
+    """Потоково читает JSON-массив объектов или JSON Lines.
+
+    Файл читается кусками, и в памяти держится только незаконченный
+    хвост текущего куска.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    while True:
+        chunk = file.read(READ_CHUNK_SIZE)
+        buffer += chunk
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in '[, \t\r\n':
+                position += 1
+            if position >= len(buffer) or buffer[position] == ']':
+                break
+            try:
+                obj, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                break
+            yield obj
+        buffer = buffer[position:]
+        if not chunk:
+            break
+    if buffer.strip(' \t\r\n]'):
+        raise CommandError(f'Некорректный JSON: {buffer[:50]!r}')
+
+
+class Command(BaseCommand):
+    help = (
+        'Загружает справочник ингредиентов или тегов из CSV- или '
+        'JSON-файлов пакетами.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', type=Path)
+        parser.add_argument(
+            '--model',
+            choices=MODELS,
+            default='ingredient',
+            help='Загружаемая модель.',
+        )
+        parser.add_argument(
+            '--format',
+            choices=('csv', 'json'),
+            help='Формат файла; по умолчанию определяется по расширению.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Количество строк в одной пачке.',
+        )
+        parser.add_argument(
+            '--upsert',
+            action='store_true',
+            help='Обновлять существующие записи вместо их пропуска.',
+        )
+        parser.add_argument(
+            '--no-copy',
+            action='store_true',
+            help='Не использовать COPY даже на PostgreSQL.',
+        )
+
+    def handle(self, *args, **options):
+        model = MODELS[options['model']][0]
+        self.changed = set()
+        try:
+            for path in options['paths']:
+                self.load_file(path, options)
+        finally:
+            # Пачки пишутся в обход сигналов моделей, поэтому кэш
+            # справочников и зависящие от него данные обновляются здесь.
+            self.refresh_derived(model, self.changed)
+
+    def load_file(self, path, options):
+        model, fields, key, prepare = MODELS[options['model']]
+        use_copy = (
+            connection.vendor == 'postgresql' and not options['no_copy']
+        )
+        load_batch = self.copy_batch if use_copy else self.create_batch
+        if not path.is_file():
+            raise CommandError(f'Файл {path} не найден.')
+        file_format = options['format'] or path.suffix.lstrip('.').lower()
+        if file_format not in ('csv', 'json', 'jsonl'):
+            raise CommandError(f'Неизвестный формат файла {path}.')
+        started = time.monotonic()
+        total = 0
+        with path.open(encoding='utf-8') as file:
+            if file_format == 'csv':
+                rows = iter_csv(file, fields)
+            else:
+                rows = iter_json(file)
+            for batch in batched(rows, options['batch_size']):
+                batch = [
+                    self.clean_row(row, fields, prepare) for row in batch
+                ]
+                with transaction.atomic():
+                    self.changed.update(
+                        load_batch(model, key, batch, options['upsert'])
+                    )
+                total += len(batch)
+        elapsed = max(time.monotonic() - started, 1e-6)
+        self.stdout.write(self.style.SUCCESS(
+            f'{path}: обработано {total} строк за {elapsed:.2f} с '
+            f'({total / elapsed:.0f} строк/с).'
+        ))
+
+    def refresh_derived(self, model, changed):
+        """Делает то же, что сигналы моделей при сохранении по одной.
+
+        Новая версия справочников сбрасывает их кэш и ETag. Для изменённых
+        ингредиентов пересчитываются поисковые векторы рецептов и версии
+        списков покупок пользователей, у которых эти рецепты в корзине.
+        """
+        bump_version(REFERENCE)
+        if model is not Ingredient:
+            return
+        for ids in batched(changed, 5000):
+            recipe_ids = RecipesIngredients.objects.filter(
+                ingredient__in=ids
+            ).values('recipe')
+            Recipe.objects.filter(pk__in=recipe_ids).update_search_vector()
+            bump_user_versions(
+                User.objects.filter(shopping_cart__recipe__in=recipe_ids),
+                'cart_version',
+            )
+
+    def clean_row(self, row, fields, prepare):
+        try:
+            row = {field: str(row[field]).strip() for field in fields}
+        except (KeyError, TypeError):
+            raise CommandError(f'Некорректная строка: {row!r}')
+        return prepare(row) if prepare else row
+
+    def create_batch(self, model, key, rows, upsert):
+        objs = {row[key]: model(**row) for row in rows}
+        changed = []
+        if upsert:
+            existing = model.objects.in_bulk(list(objs), field_name=key)
+            for value, current in existing.items():
+                new = objs.pop(value)
+                columns = [
+                    field for field in rows[0]
+                    if getattr(current, field) != getattr(new, field)
+                ]
+                if columns:
+                    new.pk = current.pk
+                    changed.append(new)
+            if changed:
+                model.objects.bulk_update(changed, list(rows[0]))
+        model.objects.bulk_create(objs.values(), ignore_conflicts=True)
+        return [obj.pk for obj in changed]
+
+    def copy_batch(self, model, key, rows, upsert):
+        """Загружает пачку через COPY во временную таблицу и INSERT.
+
+        Возвращает id существующих записей, которые изменит upsert.
+        """
+        columns = [model._meta.get_field(field).column for field in rows[0]]
+        key_column = model._meta.get_field(key).column
+        table = connection.ops.quote_name(model._meta.db_table)
+        names = ', '.join(connection.ops.quote_name(c) for c in columns)
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(row.values() for row in rows)
+        buffer.seek(0)
+        if upsert:
+            updates = ', '.join(
+                f'{name} = EXCLUDED.{name}'
+                for name in map(connection.ops.quote_name, columns)
+            )
+            conflict = (
+                f'ON CONFLICT ({connection.ops.quote_name(key_column)}) '
+                f'DO UPDATE SET {updates}'
+            )
+        else:
+            conflict = 'ON CONFLICT DO NOTHING'
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE TEMP TABLE load_rows ON COMMIT DROP AS '
+                f'SELECT {names} FROM {table} WITH NO DATA'
+            )
+            cursor.copy_expert(
+                f'COPY load_rows ({names}) FROM STDIN WITH (FORMAT csv)',
+                buffer,
+            )
+            changed = []
+            if upsert:
+                quoted = [connection.ops.quote_name(c) for c in columns]
+                current = ', '.join(f'{table}.{name}' for name in quoted)
+                loaded = ', '.join(f'load_rows.{name}' for name in quoted)
+                cursor.execute(
+                    f'SELECT DISTINCT {table}.'
+                    f'{connection.ops.quote_name(model._meta.pk.column)} '
+                    f'FROM {table} JOIN load_rows USING '
+                    f'({connection.ops.quote_name(key_column)}) '
+                    f'WHERE ({current}) IS DISTINCT FROM ({loaded})'
+                )
+                changed = [pk for pk, in cursor.fetchall()]
+            cursor.execute(
+                f'INSERT INTO {table} ({names}) '
+                f'SELECT DISTINCT ON ({connection.ops.quote_name(key_column)})'
+                f' {names} FROM load_rows {conflict}'
+            )
+        return changed
@@ -0,0 +1,129 @@
+import http.client
+import statistics
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from recipes.management.utils import percentile
+
+
+class Client(threading.Thread):
+    """Отправляет запросы по кругу через одно keep-alive соединение."""
+
+    def __init__(self, urls, headers, deadline):
+        super().__init__(daemon=True)
+        self.urls = urls
+        self.headers = headers
+        self.deadline = deadline
+        self.timings = []
+        self.errors = 0
+        self.connection = None
+
+    def connect(self, url):
+        if self.connection is None:
+            connection_class = (
+                http.client.HTTPSConnection if url.scheme == 'https'
+                else http.client.HTTPConnection
+            )
+            self.connection = connection_class(url.netloc, timeout=60)
+        return self.connection
+
+    def request(self, url):
+        path = url.path or '/'
+        if url.query:
+            path = f'{path}?{url.query}'
+        connection = self.connect(url)
+        try:
+            connection.request('GET', path, headers=self.headers)
+            response = connection.getresponse()
+            response.read()
+            return response.status < 400
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self.connection = None
+            return False
+
+    def run(self):
+        number = 0
+        while time.monotonic() < self.deadline:
+            url = self.urls[number % len(self.urls)]
+            number += 1
+            started = time.perf_counter()
+            if self.request(url):
+                self.timings.append((time.perf_counter() - started) * 1000)
+            else:
+                self.errors += 1
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный тест запущенного сервера: параллельные клиенты '
+        'запрашивают адреса по кругу, на фоне медленных запросов '
+        '--background. Выводит число запросов в секунду и задержки.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('urls', nargs='+')
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument(
+            '--duration', type=float, default=10, help='Секунды.'
+        )
+        parser.add_argument(
+            '--header', action='append', default=[],
+            help='Заголовок вида "Authorization: Token ...".',
+        )
+        parser.add_argument(
+            '--background', action='append', default=[],
+            help='Медленный адрес, например скачивание списка покупок.',
+        )
+        parser.add_argument('--background-concurrency', type=int, default=2)
+
+    def handle(self, *args, **options):
+        headers = {}
+        for header in options['header']:
+            name, separator, value = header.partition(':')
+            if not separator:
+                raise CommandError(f'Неверный заголовок: {header}')
+            headers[name.strip()] = value.strip()
+        urls = [urlsplit(url) for url in options['urls']]
+        background = [urlsplit(url) for url in options['background']]
+        deadline = time.monotonic() + options['duration']
+        groups = [('чтение', [
+            Client(urls, headers, deadline)
+            for _ in range(options['concurrency'])
+        ])]
+        if background:
+            groups.append(('фон', [
+                Client(background, headers, deadline)
+                for _ in range(options['background_concurrency'])
+            ]))
+        started = time.monotonic()
+        for _, clients in groups:
+            for client in clients:
+                client.start()
+        for _, clients in groups:
+            for client in clients:
+                client.join()
+        elapsed = time.monotonic() - started
+
+        self.stdout.write(
+            f'{"группа":<10}{"запросов":>10}{"ошибок":>8}{"в секунду":>11}'
+            f'{"p50, мс":>10}{"p95, мс":>10}{"p99, мс":>10}'
+        )
+        for name, clients in groups:
+            timings = sorted(
+                timing for client in clients for timing in client.timings
+            )
+            errors = sum(client.errors for client in clients)
+            if not timings:
+                self.stdout.write(f'{name:<10}{0:>10}{errors:>8}')
+                continue
+            self.stdout.write(
+                f'{name:<10}{len(timings):>10}{errors:>8}'
+                f'{len(timings) / elapsed:>11.1f}'
+                f'{statistics.median(timings):>10.1f}'
+                f'{percentile(timings, 0.95):>10.1f}'
+                f'{percentile(timings, 0.99):>10.1f}'
+            )
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+
+from recipes.images import needs_renditions, process_image, renditions_field
+from recipes.signals import IMAGE_FIELDS
+
+
+class Command(BaseCommand):
+    help = (
+        'Строит уменьшенные копии картинок рецептов и аватаров, '
+        'для которых их ещё нет.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Перестроить копии всех изображений.',
+        )
+
+    def handle(self, *args, **options):
+        for model, field_name in IMAGE_FIELDS.items():
+            queryset = model.objects.exclude(
+                **{f'{field_name}__isnull': True}
+            ).exclude(**{field_name: ''}).only(
+                'pk', field_name, renditions_field(field_name)
+            )
+            processed = failed = 0
+            for instance in queryset.iterator():
+                if not (
+                    options['force'] or needs_renditions(instance, field_name)
+                ):
+                    continue
+                name = getattr(instance, field_name).name
+                try:
+                    process_image(
+                        model, instance.pk, field_name, name, sync=True
+                    )
+                except OSError as error:
+                    failed += 1
+                    self.stderr.write(f'{name}: {error}')
+                else:
+                    processed += 1
+            self.stdout.write(self.style.SUCCESS(
+                f'{model._meta.verbose_name_plural}: обработано {processed}, '
+                f'ошибок {failed}.'
+            ))
@@ -0,0 +1,72 @@
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from recipes.models import ShoppingCartTotal
+
+BATCH_SIZE = 5000
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересчитывает итоги списков покупок с нуля или сверяет их '
+        'с содержимым списков.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            help='Только сверить итоги, ничего не изменяя.',
+        )
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            self.verify()
+        else:
+            self.rebuild()
+
+    @transaction.atomic
+    def rebuild(self):
+        ShoppingCartTotal.objects.all().delete()
+        rows = (
+            ShoppingCartTotal(
+                user_id=row['user'],
+                ingredient_id=row['ingredient'],
+                amount=row['total'],
+            )
+            for row in ShoppingCartTotal.objects.calculate().iterator()
+        )
+        total = 0
+        while True:
+            batch = list(islice(rows, BATCH_SIZE))
+            if not batch:
+                break
+            ShoppingCartTotal.objects.bulk_create(batch)
+            total += len(batch)
+        self.stdout.write(self.style.SUCCESS(
+            f'Итоги списков покупок пересчитаны: {total} строк.'
+        ))
+
+    def verify(self):
+        expected = {
+            (row['user'], row['ingredient']): row['total']
+            for row in ShoppingCartTotal.objects.calculate().iterator()
+        }
+        mismatches = 0
+        stored = ShoppingCartTotal.objects.values_list(
+            'user_id', 'ingredient_id', 'amount'
+        )
+        for user_id, ingredient_id, amount in stored.iterator():
+            if expected.pop((user_id, ingredient_id), None) != amount:
+                mismatches += 1
+        mismatches += len(expected)
+        if mismatches:
+            raise CommandError(
+                f'Расхождений в итогах списков покупок: {mismatches}. '
+                f'Запустите команду без --verify для пересчёта.'
+            )
+        self.stdout.write(self.style.SUCCESS(
+            'Итоги списков покупок совпадают со списками.'
+        ))
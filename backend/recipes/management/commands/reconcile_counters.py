@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from recipes.models import Favorite, Recipe
+from recipes.versions import FAVORITES, bump_version
+from users.models import Subscribe, User
+
+
+def actual_count(queryset, field):
+    """Подзапрос с фактическим числом связанных строк."""
+    return Coalesce(Subquery(
+        queryset.filter(
+            **{field: OuterRef('pk')}
+        ).order_by().values(field).annotate(total=Count('id')).values('total')
+    ), 0)
+
+
+COUNTERS = (
+    (Recipe, 'favorites_count', Favorite.objects, 'recipe'),
+    (User, 'recipes_count', Recipe.objects, 'author'),
+    (User, 'followers_count', Subscribe.objects, 'author'),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Сверяет денормализованные счётчики favorites_count, '
+        'recipes_count и followers_count с фактическими данными '
+        'и исправляет расхождения.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Только показать количество расхождений.',
+        )
+
+    def handle(self, *args, **options):
+        for model, counter, related, field in COUNTERS:
+            with transaction.atomic():
+                broken = model.objects.annotate(
+                    actual=actual_count(related, field)
+                ).exclude(**{counter: F('actual')})
+                ids = list(broken.values_list('pk', flat=True))
+                if ids and not options['dry_run']:
+                    model.objects.filter(pk__in=ids).update(
+                        **{counter: actual_count(related, field)}
+                    )
+                    if counter == 'favorites_count':
+                        bump_version(FAVORITES)
+            self.stdout.write(
+                f'{model._meta.verbose_name_plural}.{counter}: '
+                f'расхождений {len(ids)}.'
+            )
@@ -0,0 +1,80 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from recipes.seeding import Seeder
+
+
+class Command(BaseCommand):
+    help = (
+        'Создаёт синтетические данные продакшен-масштаба: пользователей, '
+        'подписки, рецепты с ингредиентами и тегами, избранное и списки '
+        'покупок с популярностью по Ципфу. В PostgreSQL строки пишутся '
+        'через COPY. Результат определяется --seed и не зависит от '
+        '--workers. Пример: seed_scale --users 1000000 --recipes 5000000 '
+        '--favorites 50000000 --workers 8'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--recipes', type=int, default=50000)
+        parser.add_argument(
+            '--subscriptions', type=int,
+            help='Всего подписок; по умолчанию 20 на пользователя.',
+        )
+        parser.add_argument(
+            '--favorites', type=int,
+            help='Всего записей избранного; по умолчанию 20 на пользователя.',
+        )
+        parser.add_argument(
+            '--cart', type=int,
+            help='Всего рецептов в списках покупок; по умолчанию 5 на '
+                 'пользователя.',
+        )
+        parser.add_argument('--tags', type=int, default=10)
+        parser.add_argument('--ingredients', type=int, default=2000)
+        parser.add_argument(
+            '--skew', type=float, default=1.1,
+            help='Показатель распределения Ципфа для популярности.',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Число процессов для записи.',
+        )
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--prefix', default='scale',
+            help='Префикс имён пользователей, тегов и ингредиентов.',
+        )
+        parser.add_argument(
+            '--skip-feed', action='store_true',
+            help='Не заполнять ленты подписок.',
+        )
+
+    def handle(self, *args, **options):
+        if options['users'] < 2 or options['recipes'] < 1:
+            raise CommandError('Нужно минимум 2 пользователя и 1 рецепт.')
+        started = time.perf_counter()
+        try:
+            seeder = Seeder(
+                options['prefix'], options['seed'], stdout=self.stdout
+            ).seed(
+                options['users'], options['recipes'],
+                subscriptions=options['subscriptions'],
+                favorites=options['favorites'],
+                cart=options['cart'],
+                tags=options['tags'],
+                ingredients=options['ingredients'],
+                workers=options['workers'],
+                feed=not options['skip_feed'],
+                skew=options['skew'],
+            )
+        except RuntimeError as error:
+            raise CommandError(error)
+        self.stdout.write(self.style.SUCCESS(
+            f'Создано за {time.perf_counter() - started:.1f} с: '
+            f'{len(seeder.user_ids)} пользователей '
+            f'(id {seeder.user_ids.start}–{seeder.user_ids.stop - 1}), '
+            f'{len(seeder.recipe_ids)} рецептов '
+            f'(id {seeder.recipe_ids.start}–{seeder.recipe_ids.stop - 1}).'
+        ))
@@ -0,0 +1,13 @@
+from itertools import islice
+
+
+def batched(iterable, size):
+    """Делит последовательность на списки не длиннее size."""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def percentile(timings, share):
+    """Перцентиль по отсортированному списку замеров."""
+    return timings[min(len(timings) - 1, int(len(timings) * share))]
@@ -0,0 +1,67 @@
+# Generated by Django 3.2.3 on 2026-10-18 10:00
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+FILL_FEED_SQL = '''
+    INSERT INTO recipes_feedentry (user_id, recipe_id, author_id, pub_date)
+    SELECT follow.user_id, recent.id, recent.author_id, recent.pub_date
+    FROM (
+        SELECT id, author_id, pub_date,
+               ROW_NUMBER() OVER (
+                   PARTITION BY author_id ORDER BY pub_date DESC, id DESC
+               ) AS row_number
+        FROM recipes_recipe
+        WHERE author_id IS NOT NULL
+    ) AS recent
+    JOIN users_subscribe AS follow ON follow.author_id = recent.author_id
+    JOIN users_user AS author ON author.id = recent.author_id
+    WHERE recent.row_number <= %s AND author.followers_count <= %s
+'''
+
+
+def fill_feed(apps, schema_editor):
+    schema_editor.execute(
+        FILL_FEED_SQL,
+        [settings.FEED_BACKFILL_SIZE, settings.FEED_FANOUT_LIMIT],
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('users', '0007_user_followers_count'),
+        ('recipes', '0009_recipe_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pub_date', models.DateTimeField(verbose_name='Дата публикации')),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='Автор')),
+                ('recipe', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feed_entries', to='recipes.recipe', verbose_name='Рецепт')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='feed_entries', to=settings.AUTH_USER_MODEL, verbose_name='Читатель')),
+            ],
+            options={
+                'verbose_name': 'запись ленты',
+                'verbose_name_plural': 'Ленты подписок',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['author', '-pub_date', '-id'], name='recipe_author_pub_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='feedentry',
+            index=models.Index(fields=['user', '-pub_date', '-recipe'], name='feed_user_pub_date_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='feedentry',
+            constraint=models.UniqueConstraint(fields=('user', 'recipe'), name='unique_feed_entry'),
+        ),
+        migrations.RunPython(fill_feed, migrations.RunPython.noop),
+    ]
@@ -1,10 +1,28 @@
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import (
+    SearchQuery,
+    SearchRank,
+    SearchVector,
+    SearchVectorField
+)
 from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
-from django.db.models import UniqueConstraint
+from django.db import connection, models
+from django.db.models import (
+    F,
+    FloatField,
+    OuterRef,
+    Subquery,
+    UniqueConstraint,
+    Value
+)
+from django.dispatch import Signal
 from django.urls import reverse
+from django.utils import timezone
 
-from users.models import User
+from users.models import Subscribe, User
 
 from .consts import (
     LEN_COLOR,
@@ -48,6 +66,11 @@ class Tag(models.Model):
         return f'{self.name} (цвет: {self.color})'
 
 
+def fold_search_name(value):
+    """Приводит название к виду для поиска: без регистра и буквы «ё»."""
+    return value.strip().lower().replace('ё', 'е')
+
+
 class Ingredient(models.Model):
 
     name = models.CharField(
@@ -61,14 +84,78 @@ class Ingredient(models.Model):
         max_length=LEN_INGREDIENT_MEASUREMENT_UNIT,
         help_text='Единица измерения',
     )
+    search_name = models.CharField(
+        'Название для поиска',
+        max_length=LEN_INGREDIENT_NAME,
+        db_index=True,
+        editable=False,
+    )
 
     class Meta:
         verbose_name = 'ингредиент'
         verbose_name_plural = 'Ингредиенты'
+        indexes = [
+            GinIndex(
+                fields=['search_name'],
+                name='ingredient_search_name_trgm',
+                opclasses=['gin_trgm_ops'],
+            ),
+        ]
 
     def __str__(self) -> str:
         return f'{self.name} {self.measurement_unit}'
 
+    def save(self, *args, **kwargs):
+        self.search_name = fold_search_name(self.name)
+        super().save(*args, **kwargs)
+
+
+SEARCH_CONFIG = 'russian'
+
+
+class RecipeQuerySet(models.QuerySet):
+
+    def update_search_vector(self):
+        """Пересчитывает поисковый вектор выбранных рецептов одним UPDATE.
+
+        В вектор входят название (вес A), названия ингредиентов (B) и
+        описание (C). Полнотекстовый поиск есть только в PostgreSQL, на
+        других базах вектор не заполняется.
+        """
+        if connection.vendor != 'postgresql':
+            return 0
+        ingredient_names = Subquery(
+            RecipesIngredients.objects.filter(
+                recipe=OuterRef('pk')
+            ).order_by().values('recipe').annotate(
+                names=StringAgg('ingredient__name', ' ')
+            ).values('names'),
+            output_field=models.TextField(),
+        )
+        return self.update(search_vector=(
+            SearchVector('name', weight='A', config=SEARCH_CONFIG)
+            + SearchVector(ingredient_names, weight='B', config=SEARCH_CONFIG)
+            + SearchVector('text', weight='C', config=SEARCH_CONFIG)
+        ))
+
+    def search(self, query):
+        """Рецепты, подходящие под запрос, по убыванию релевантности.
+
+        Запрос разбирается как в поисковиках (websearch_to_tsquery), условие
+        проверяется по GIN-индексу, релевантность считает ts_rank. Вне
+        PostgreSQL — простой поиск по названию с нулевым рангом.
+        """
+        if connection.vendor != 'postgresql':
+            return self.filter(name__icontains=query).annotate(
+                rank=Value(0.0, output_field=FloatField())
+            ).order_by('-rank', '-id')
+        search_query = SearchQuery(
+            query, config=SEARCH_CONFIG, search_type='websearch'
+        )
+        return self.filter(search_vector=search_query).annotate(
+            rank=SearchRank(F('search_vector'), search_query)
+        ).order_by('-rank', '-id')
+
 
 class Recipe(models.Model):
     """Рецепты."""
@@ -88,6 +175,11 @@ class Recipe(models.Model):
         upload_to='recipe_images',
         verbose_name='Картинка рецепта',
     )
+    image_renditions = models.JSONField(
+        'Уменьшенные копии картинки',
+        default=dict,
+        editable=False,
+    )
     text = models.TextField(
         'Описание рецепта',
         help_text='Описание рецепта.',
@@ -116,11 +208,45 @@ class Recipe(models.Model):
         'Дата публикации',
         auto_now_add=True,
     )
+    updated_at = models.DateTimeField(
+        'Дата изменения',
+        auto_now=True,
+    )
+    favorites_count = models.PositiveIntegerField(
+        'Количество добавлений в избранное',
+        default=0,
+        editable=False,
+    )
+    search_vector = SearchVectorField(
+        'Поисковый вектор',
+        null=True,
+        editable=False,
+    )
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
         ordering = ['-pub_date']
         verbose_name = 'рецепт'
         verbose_name_plural = 'Рецепты'
+        indexes = [
+            models.Index(
+                fields=['-pub_date', '-id'],
+                name='recipe_pub_date_id_idx',
+            ),
+            models.Index(
+                fields=['-favorites_count', '-id'],
+                name='recipe_favorites_count_idx',
+            ),
+            models.Index(
+                fields=['author', '-pub_date', '-id'],
+                name='recipe_author_pub_date_idx',
+            ),
+            GinIndex(
+                fields=['search_vector'],
+                name='recipe_search_vector_idx',
+            ),
+        ]
 
     def clean(self):
         super().clean()
@@ -135,6 +261,71 @@ class Recipe(models.Model):
         return reverse('recipe-detail', kwargs={'pk': self.pk})
 
 
+# Отправляются после массового добавления и удаления рецептов
+# пользователя вместо post_save и post_delete по каждой строке.
+recipes_added = Signal()
+recipes_removed = Signal()
+
+
+class UserRecipeManager(models.Manager):
+    """Рецепты в избранном и списке покупок: запись одним запросом."""
+
+    def add(self, user_id, recipe_ids):
+        """Добавляет рецепты пользователю и возвращает id добавленных.
+
+        Один INSERT ... SELECT: несуществующие рецепты отсеиваются в нём
+        же, а уже добавленные пропускаются по ограничению уникальности,
+        поэтому повторный или одновременный запрос не приводит к
+        IntegrityError. Добавленные строки возвращает RETURNING.
+        """
+        if not recipe_ids:
+            return []
+        placeholders = ', '.join(['%s'] * len(recipe_ids))
+        pub_date = self.model._meta.get_field('pub_date').get_db_prep_save(
+            timezone.now(), connection
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'''
+                INSERT INTO {self.model._meta.db_table}
+                    (user_id, recipe_id, pub_date)
+                SELECT %s, recipe.id, %s
+                FROM {Recipe._meta.db_table} AS recipe
+                WHERE recipe.id IN ({placeholders})
+                ON CONFLICT (user_id, recipe_id) DO NOTHING
+                RETURNING recipe_id
+                ''',
+                [user_id, pub_date, *recipe_ids],
+            )
+            added = [recipe_id for recipe_id, in cursor.fetchall()]
+        if added:
+            recipes_added.send(
+                sender=self.model, user_id=user_id, recipe_ids=added
+            )
+        return added
+
+    def remove(self, user_id, recipe_ids):
+        """Удаляет рецепты у пользователя и возвращает id удалённых."""
+        if not recipe_ids:
+            return []
+        placeholders = ', '.join(['%s'] * len(recipe_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'''
+                DELETE FROM {self.model._meta.db_table}
+                WHERE user_id = %s AND recipe_id IN ({placeholders})
+                RETURNING recipe_id
+                ''',
+                [user_id, *recipe_ids],
+            )
+            removed = [recipe_id for recipe_id, in cursor.fetchall()]
+        if removed:
+            recipes_removed.send(
+                sender=self.model, user_id=user_id, recipe_ids=removed
+            )
+        return removed
+
+
 class ShoppingCart(models.Model):
     """Список покупок."""
 
@@ -155,6 +346,8 @@ class ShoppingCart(models.Model):
         auto_now_add=True,
     )
 
+    objects = UserRecipeManager()
+
     class Meta:
         verbose_name = 'Список покупок'
         verbose_name_plural = 'Списки покупок'
@@ -165,6 +358,12 @@ class ShoppingCart(models.Model):
                 name='unique_shopping_cart',
             )
         ]
+        indexes = [
+            models.Index(
+                fields=['user', '-pub_date'],
+                name='cart_user_pub_date_idx',
+            ),
+        ]
 
     def __str__(self):
         return (
@@ -192,6 +391,8 @@ class Favorite(models.Model):
         auto_now_add=True,
     )
 
+    objects = UserRecipeManager()
+
     class Meta:
         verbose_name = 'избранное'
         verbose_name_plural = 'Избранное'
@@ -202,11 +403,77 @@ class Favorite(models.Model):
                 name='unique_favorite'
             )
         ]
+        indexes = [
+            models.Index(
+                fields=['user', '-pub_date'],
+                name='favorite_user_pub_date_idx',
+            ),
+        ]
 
     def __str__(self):
         return f'{self.user} добавил "{self.recipe}" в Избранное'
 
 
+# Отправляется, когда состав рецепта изменён без построчных сигналов.
+ingredients_changed = Signal()
+
+
+class RecipesIngredientsManager(models.Manager):
+    """Запись состава рецепта."""
+
+    def sync(self, recipe_id, amounts):
+        """Приводит состав рецепта к {id ингредиента: количество}.
+
+        Пишутся только отличия: новые строки добавляются одним INSERT,
+        изменённые количества — одним UPDATE, лишние строки удаляются
+        одним DELETE. Итоги списков покупок пересчитываются, только если
+        состав изменился. Вместо post_save и post_delete по каждой строке
+        отправляется один ingredients_changed. Возвращает True, если
+        состав изменился.
+        """
+        existing = {
+            ingredient_id: (pk, amount)
+            for pk, ingredient_id, amount in self.filter(
+                recipe_id=recipe_id
+            ).values_list('pk', 'ingredient_id', 'amount')
+        }
+        deleted = [
+            pk for ingredient_id, (pk, _) in existing.items()
+            if ingredient_id not in amounts
+        ]
+        updated = [
+            self.model(pk=pk, amount=amounts[ingredient_id])
+            for ingredient_id, (pk, amount) in existing.items()
+            if amounts.get(ingredient_id, amount) != amount
+        ]
+        created = [
+            self.model(
+                recipe_id=recipe_id, ingredient_id=ingredient_id,
+                amount=amount,
+            )
+            for ingredient_id, amount in amounts.items()
+            if ingredient_id not in existing
+        ]
+        if not (deleted or updated or created):
+            return False
+        ShoppingCartTotal.objects.apply_recipe(recipe_id, -1)
+        if deleted:
+            placeholders = ', '.join(['%s'] * len(deleted))
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'DELETE FROM {self.model._meta.db_table} '
+                    f'WHERE id IN ({placeholders})',
+                    deleted,
+                )
+        if updated:
+            self.bulk_update(updated, ['amount'])
+        if created:
+            self.bulk_create(created)
+        ShoppingCartTotal.objects.apply_recipe(recipe_id, 1)
+        ingredients_changed.send(sender=self.model, recipe_id=recipe_id)
+        return True
+
+
 class RecipesIngredients(models.Model):
     """Создание модели связанных ингредиентов в рецептах."""
 
@@ -228,12 +495,282 @@ class RecipesIngredients(models.Model):
         verbose_name='Количество',
     )
 
+    objects = RecipesIngredientsManager()
+
     class Meta:
         verbose_name = 'количество ингредиента'
         verbose_name_plural = 'Количество ингредиента'
+        indexes = [
+            models.Index(
+                fields=['recipe', 'ingredient'],
+                name='recipe_ingredient_idx',
+            ),
+        ]
 
     def __str__(self):
         return (
             f'''{self.ingredient.name}
             ({self.ingredient.measurement_unit}) - {self.amount}'''
         )
+
+
+class ShoppingCartTotalManager(models.Manager):
+    """Инкрементальное обновление итогов списков покупок."""
+
+    def apply_recipe(self, recipe_id, sign, user_id=None):
+        """Прибавляет или вычитает ингредиенты рецепта из итогов.
+
+        Затрагивает пользователей, у которых рецепт лежит в списке
+        покупок, либо только user_id, если он передан. При sign=1
+        количества прибавляются, при sign=-1 вычитаются, а ставшие
+        нулевыми строки удаляются.
+        """
+        totals = self.model._meta.db_table
+        params = [sign, recipe_id]
+        user_filter = ''
+        if user_id is not None:
+            user_filter = 'AND cart.user_id = %s'
+            params.append(user_id)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'''
+                INSERT INTO {totals} (user_id, ingredient_id, amount)
+                SELECT cart.user_id, item.ingredient_id, %s * SUM(item.amount)
+                FROM {RecipesIngredients._meta.db_table} AS item
+                JOIN {ShoppingCart._meta.db_table} AS cart
+                    ON cart.recipe_id = item.recipe_id
+                WHERE item.recipe_id = %s {user_filter}
+                GROUP BY cart.user_id, item.ingredient_id
+                ON CONFLICT (user_id, ingredient_id)
+                DO UPDATE SET amount = {totals}.amount + EXCLUDED.amount
+                ''',
+                params,
+            )
+        if sign < 0:
+            emptied = self.filter(amount__lte=0)
+            if user_id is not None:
+                emptied = emptied.filter(user_id=user_id)
+            else:
+                emptied = emptied.filter(
+                    user__shopping_cart__recipe=recipe_id
+                )
+            emptied.delete()
+
+    def apply_ingredient(self, recipe_id, ingredient_id, amount):
+        """Меняет на amount итог ингредиента у всех, у кого рецепт в списке.
+
+        Нужен при правке одной строки состава рецепта.
+        """
+        totals = self.model._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'''
+                INSERT INTO {totals} (user_id, ingredient_id, amount)
+                SELECT cart.user_id, %s, %s
+                FROM {ShoppingCart._meta.db_table} AS cart
+                WHERE cart.recipe_id = %s
+                ON CONFLICT (user_id, ingredient_id)
+                DO UPDATE SET amount = {totals}.amount + EXCLUDED.amount
+                ''',
+                [ingredient_id, amount, recipe_id],
+            )
+        if amount < 0:
+            self.filter(
+                ingredient_id=ingredient_id,
+                amount__lte=0,
+                user__shopping_cart__recipe=recipe_id,
+            ).delete()
+
+    def apply_user_recipes(self, user_id, recipe_ids, sign):
+        """Прибавляет или вычитает ингредиенты рецептов из итогов user_id.
+
+        В отличие от apply_recipe не смотрит в список покупок: рецепты
+        уже добавлены в него или удалены из него, и их вклад учитывается
+        ровно один раз.
+        """
+        totals = self.model._meta.db_table
+        placeholders = ', '.join(['%s'] * len(recipe_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'''
+                INSERT INTO {totals} (user_id, ingredient_id, amount)
+                SELECT %s, item.ingredient_id, %s * SUM(item.amount)
+                FROM {RecipesIngredients._meta.db_table} AS item
+                WHERE item.recipe_id IN ({placeholders})
+                GROUP BY item.ingredient_id
+                ON CONFLICT (user_id, ingredient_id)
+                DO UPDATE SET amount = {totals}.amount + EXCLUDED.amount
+                ''',
+                [user_id, sign, *recipe_ids],
+            )
+        if sign < 0:
+            self.filter(user_id=user_id, amount__lte=0).delete()
+
+    def calculate(self):
+        """Итоги, посчитанные заново по спискам покупок."""
+        return RecipesIngredients.objects.filter(
+            recipe__shopping_cart__isnull=False
+        ).values(
+            'ingredient',
+            user=models.F('recipe__shopping_cart__user'),
+        ).annotate(
+            total=models.Sum('amount')
+        ).order_by('user', 'ingredient')
+
+
+class ShoppingCartTotal(models.Model):
+    """Суммарное количество ингредиента в списке покупок пользователя."""
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='cart_totals',
+        verbose_name='Пользователь',
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='cart_totals',
+        verbose_name='Ингредиент',
+    )
+    amount = models.IntegerField('Количество')
+
+    objects = ShoppingCartTotalManager()
+
+    class Meta:
+        verbose_name = 'итог списка покупок'
+        verbose_name_plural = 'Итоги списков покупок'
+        constraints = [
+            UniqueConstraint(
+                fields=['user', 'ingredient'],
+                name='unique_cart_total'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.user}: {self.ingredient} - {self.amount}'
+
+
+class FeedEntryManager(models.Manager):
+    """Раздача рецептов по лентам подписчиков при публикации."""
+
+    def fan_out(self, recipe_ids, user_id=None):
+        """Добавляет рецепты в ленты подписчиков их авторов.
+
+        Авторы, у которых подписчиков больше FEED_FANOUT_LIMIT,
+        пропускаются: их рецепты лента подмешивает при чтении. Если
+        передан user_id, заполняется только его лента.
+        """
+        if not recipe_ids:
+            return
+        feed = self.model._meta.db_table
+        placeholders = ', '.join(['%s'] * len(recipe_ids))
+        params = [settings.FEED_FANOUT_LIMIT, *recipe_ids]
+        user_filter = ''
+        if user_id is not None:
+            user_filter = 'AND follow.user_id = %s'
+            params.append(user_id)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'''
+                INSERT INTO {feed} (user_id, recipe_id, author_id, pub_date)
+                SELECT follow.user_id, recipe.id, recipe.author_id,
+                       recipe.pub_date
+                FROM {Recipe._meta.db_table} AS recipe
+                JOIN {Subscribe._meta.db_table} AS follow
+                    ON follow.author_id = recipe.author_id
+                JOIN {User._meta.db_table} AS author
+                    ON author.id = recipe.author_id
+                WHERE author.followers_count <= %s
+                    AND recipe.id IN ({placeholders}) {user_filter}
+                ON CONFLICT (user_id, recipe_id) DO NOTHING
+                ''',
+                params,
+            )
+
+    def fan_out_recent(self, author_id, user_id=None):
+        """Дополняет ленты последними FEED_BACKFILL_SIZE рецептами автора."""
+        self.fan_out(
+            list(Recipe.objects.filter(author_id=author_id).order_by(
+                '-pub_date', '-id'
+            ).values_list('id', flat=True)[:settings.FEED_BACKFILL_SIZE]),
+            user_id=user_id,
+        )
+
+    def backfill(self):
+        """Заполняет все ленты последними FEED_BACKFILL_SIZE рецептами.
+
+        Одним запросом по всем авторам; нужно после массовой загрузки
+        рецептов и подписок в обход сигналов.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'''
+                INSERT INTO {self.model._meta.db_table}
+                    (user_id, recipe_id, author_id, pub_date)
+                SELECT follow.user_id, recent.id, recent.author_id,
+                       recent.pub_date
+                FROM (
+                    SELECT id, author_id, pub_date,
+                           ROW_NUMBER() OVER (
+                               PARTITION BY author_id
+                               ORDER BY pub_date DESC, id DESC
+                           ) AS row_number
+                    FROM {Recipe._meta.db_table}
+                    WHERE author_id IS NOT NULL
+                ) AS recent
+                JOIN {Subscribe._meta.db_table} AS follow
+                    ON follow.author_id = recent.author_id
+                JOIN {User._meta.db_table} AS author
+                    ON author.id = recent.author_id
+                WHERE recent.row_number <= %s
+                    AND author.followers_count <= %s
+                ON CONFLICT (user_id, recipe_id) DO NOTHING
+                ''',
+                [settings.FEED_BACKFILL_SIZE, settings.FEED_FANOUT_LIMIT],
+            )
+
+
+class FeedEntry(models.Model):
+    """Рецепт в ленте пользователя от автора, на которого он подписан."""
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='Читатель',
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='Рецепт',
+    )
+    author = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Автор',
+    )
+    pub_date = models.DateTimeField('Дата публикации')
+
+    objects = FeedEntryManager()
+
+    class Meta:
+        verbose_name = 'запись ленты'
+        verbose_name_plural = 'Ленты подписок'
+        constraints = [
+            UniqueConstraint(
+                fields=['user', 'recipe'],
+                name='unique_feed_entry'
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=['user', '-pub_date', '-recipe'],
+                name='feed_user_pub_date_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.user}: {self.recipe}'
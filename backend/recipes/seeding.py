@@ -0,0 +1,581 @@
+import base64
+import json
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from functools import lru_cache
+from io import BytesIO, StringIO
+from multiprocessing import get_context
+
+import django
+import numpy as np
+from django.core.management import call_command
+from django.core.management.color import no_style
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+from PIL import Image
+
+from users.models import Subscribe, User
+
+from .management.utils import batched
+from .models import (
+    Favorite,
+    FeedEntry,
+    Ingredient,
+    Recipe,
+    RecipesIngredients,
+    ShoppingCart,
+    Tag,
+    fold_search_name
+)
+from .versions import FAVORITES, RECIPES, REFERENCE, bump_version
+
+BATCH_SIZE = 5000
+# Сколько раз подбирать цвета тегов заново при столкновении.
+TAG_COLOR_ATTEMPTS = 5
+# Порция строк для одного задания; у каждой порции свой генератор
+# случайных чисел, поэтому данные не зависят от числа процессов.
+CHUNK_SIZE = 20000
+PREPARED_TYPES = ('DateTimeField', 'JSONField')
+HISTORY = timedelta(days=3 * 365)
+UNITS = ('г', 'кг', 'мл', 'л', 'шт.', 'ст. л.', 'ч. л.', 'по вкусу')
+FIRST_NAMES = (
+    'Анна', 'Мария', 'Елена', 'Ольга', 'Наталья', 'Ирина', 'Татьяна',
+    'Александр', 'Сергей', 'Дмитрий', 'Андрей', 'Алексей', 'Максим',
+    'Иван', 'Михаил', 'Никита',
+)
+LAST_NAMES = (
+    'Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Петров',
+    'Соколов', 'Михайлов', 'Новиков', 'Фёдоров', 'Морозов', 'Волков',
+)
+DISHES = (
+    'Суп', 'Салат', 'Пирог', 'Рагу', 'Омлет', 'Паста', 'Плов', 'Запеканка',
+    'Каша', 'Котлеты', 'Блины', 'Оладьи', 'Борщ', 'Жаркое', 'Ризотто',
+)
+FILLINGS = (
+    'с курицей', 'с грибами', 'с сыром', 'с овощами', 'с говядиной',
+    'с рыбой', 'с яблоками', 'с тыквой', 'с фасолью', 'с зеленью',
+    'по-домашнему', 'по-деревенски', 'со сметаной', 'с рисом',
+)
+STEPS = (
+    'Нарежьте ингредиенты.', 'Обжарьте на среднем огне.',
+    'Добавьте специи по вкусу.', 'Тушите под крышкой.',
+    'Запекайте в духовке до румяной корочки.', 'Подавайте горячим.',
+    'Перемешайте и дайте настояться.', 'Отварите до готовности.',
+)
+
+
+def sample_image():
+    """Картинка рецепта в base64, как её присылает фронтенд."""
+    buffer = BytesIO()
+    Image.new('RGB', (640, 480), (200, 120, 40)).save(buffer, 'PNG')
+    return 'data:image/png;base64,' + base64.b64encode(
+        buffer.getvalue()
+    ).decode()
+
+
+def copy_value(value):
+    """Значение в текстовом формате COPY."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, dict):
+        value = json.dumps(value, ensure_ascii=False)
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n'
+    ).replace('\r', '\\r')
+
+
+class CopyStream:
+    """Файлоподобный поток строк COPY из генератора кортежей."""
+
+    def __init__(self, rows, defaults):
+        self.lines = (
+            '\t'.join(map(copy_value, row + defaults)) + '\n' for row in rows
+        )
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer += line
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+    readline = read
+
+
+def write_rows(model, columns, rows):
+    """Пишет поток кортежей в таблицу модели.
+
+    columns — attname полей в порядке значений кортежа, остальные поля
+    получают значения по умолчанию. В PostgreSQL строки идут через COPY,
+    в других базах — многострочными INSERT пачками по BATCH_SIZE.
+    Сигналы и pre_save не вызываются, так что pub_date и другие
+    auto_now-поля можно задать явно.
+    """
+    fields = {field.attname: field for field in model._meta.concrete_fields}
+    rest = [
+        field for name, field in fields.items()
+        if name not in columns and not field.primary_key
+    ]
+    defaults = tuple(field.get_default() for field in rest)
+    names = [fields[name].column for name in columns] + [
+        field.column for field in rest
+    ]
+    table = connection.ops.quote_name(model._meta.db_table)
+    column_list = ', '.join(map(connection.ops.quote_name, names))
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.copy_expert(
+                f'COPY {table} ({column_list}) FROM STDIN',
+                CopyStream(rows, defaults),
+            )
+            return
+        # Числа и строки драйвер принимает как есть, подготовки требуют
+        # только даты и JSON; вызов get_db_prep_save на каждое значение
+        # обходится дороже самой вставки.
+        prepared = [
+            (index, field) for index, field in enumerate(
+                [fields[name] for name in columns] + rest
+            )
+            if field.get_internal_type() in PREPARED_TYPES
+        ]
+        placeholders = ', '.join(['%s'] * len(names))
+        for batch in batched(rows, BATCH_SIZE):
+            values = [list(row + defaults) for row in batch]
+            for row in values:
+                for index, field in prepared:
+                    row[index] = field.get_db_prep_save(row[index], connection)
+            cursor.executemany(
+                f'INSERT INTO {table} ({column_list}) '
+                f'VALUES ({placeholders})',
+                values,
+            )
+
+
+@lru_cache(maxsize=None)
+def zipf_cdf(size, skew):
+    """Накопленные веса рангов 1..size, пропорциональные 1 / rank^skew."""
+    weights = np.arange(1, size + 1, dtype=np.float64) ** -skew
+    return np.cumsum(weights) / weights.sum()
+
+
+def tag_color(slug, attempt=0):
+    """Цвет тега из его slug: у тегов разных префиксов он разный."""
+    return f'#{zlib.crc32(f"{slug}:{attempt}".encode()) & 0xffffff:06x}'
+
+
+@lru_cache(maxsize=None)
+def permutation(size, seed, salt):
+    """Какой объект занимает ранг популярности; своя для каждой роли."""
+    return np.random.default_rng(
+        [seed, zlib.crc32(salt.encode())]
+    ).permutation(size)
+
+
+@lru_cache(maxsize=None)
+def activity_weights(size, skew, seed, salt):
+    """Доля связей каждого пользователя, индексированная по пользователю."""
+    weights = np.diff(zipf_cdf(size, skew), prepend=0.0)
+    result = np.empty(size)
+    result[permutation(size, seed, salt)] = weights
+    return result
+
+
+class SeedPlan:
+    """Параметры генерации; передаются процессам-исполнителям.
+
+    Каждая порция данных генерируется своим генератором случайных чисел
+    от (seed, таблица, номер порции), поэтому результат не зависит от
+    числа процессов и порядка их работы.
+    """
+
+    TABLES = (
+        'users', 'recipes', 'recipe_ingredients', 'recipe_tags',
+        'subscriptions', 'favorites', 'cart',
+    )
+
+    def __init__(self, prefix, seed, users, recipes, subscriptions,
+                 favorites, cart, skew=1.1, activity_skew=0.7):
+        self.prefix = prefix
+        self.seed = seed
+        self.users = users
+        self.recipes = recipes
+        self.totals = {
+            'subscriptions': subscriptions,
+            'favorites': favorites,
+            'cart': cart,
+        }
+        self.skew = skew
+        self.activity_skew = activity_skew
+        self.until = timezone.now().replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+
+    def bind(self, first_user, first_recipe, tag_ids, ingredient_ids):
+        self.first_user = first_user
+        self.first_recipe = first_recipe
+        self.tag_ids = np.asarray(tag_ids)
+        self.ingredient_ids = np.asarray(ingredient_ids)
+
+    def chunks(self, table):
+        size = self.recipes if table.startswith('recipe') else self.users
+        return range(0, size, CHUNK_SIZE)
+
+    def rng(self, table, start):
+        return np.random.default_rng(
+            [self.seed, self.TABLES.index(table), start]
+        )
+
+    def popular(self, rng, size, count, salt):
+        """Индексы 0..size-1 с распределением популярности Ципфа."""
+        ranks = np.searchsorted(
+            zipf_cdf(size, self.skew), rng.random(count), side='right'
+        )
+        return permutation(size, self.seed, salt)[np.minimum(ranks, size - 1)]
+
+    def activity(self, rng, table, start, stop):
+        """Сколько связей создаёт каждый пользователь порции.
+
+        Активность тоже распределена по Ципфу, но мягче популярности,
+        и ограничена числом доступных объектов.
+        """
+        weights = activity_weights(
+            self.users, self.activity_skew, self.seed, table
+        )
+        expected = weights[start:stop] * self.totals[table]
+        counts = np.floor(expected + rng.random(len(expected)))
+        limit = self.users - 1 if table == 'subscriptions' else self.recipes
+        return np.minimum(counts, limit).astype(np.int64)
+
+    def recipe_dates(self, recipe_indexes):
+        """Дата публикации растёт вместе с id, как у настоящих рецептов."""
+        step = HISTORY / max(self.recipes, 1)
+        return [self.until - HISTORY + step * int(index)
+                for index in recipe_indexes]
+
+    def pairs(self, rng, table, start, stop, size, salt):
+        """Уникальные пары (пользователь, объект) для порции пользователей."""
+        counts = self.activity(rng, table, start, stop)
+        users = np.repeat(np.arange(start, stop), counts)
+        targets = self.popular(rng, size, len(users), salt)
+        if table == 'subscriptions':
+            keep = users != targets
+            users, targets = users[keep], targets[keep]
+        keys = np.unique(users * size + targets)
+        return keys // size, keys % size
+
+    def generate(self, table, start):
+        """Строки таблицы для порции, начинающейся с индекса start."""
+        rng = self.rng(table, start)
+        stop = min(start + CHUNK_SIZE, self.recipes if table.startswith(
+            'recipe'
+        ) else self.users)
+        return getattr(self, f'generate_{table}')(rng, start, stop)
+
+    def generate_users(self, rng, start, stop):
+        step = HISTORY / max(self.users, 1)
+        first_names = rng.integers(len(FIRST_NAMES), size=stop - start)
+        last_names = rng.integers(len(LAST_NAMES), size=stop - start)
+        columns = (
+            'id', 'username', 'email', 'first_name', 'last_name',
+            'password', 'date_joined', 'is_active', 'is_staff',
+            'is_superuser',
+        )
+        rows = (
+            (
+                self.first_user + index,
+                f'{self.prefix}{index}',
+                f'{self.prefix}{index}@example.com',
+                FIRST_NAMES[first_names[index - start]],
+                LAST_NAMES[last_names[index - start]],
+                '!',
+                self.until - HISTORY + step * index,
+                True, False, False,
+            )
+            for index in range(start, stop)
+        )
+        return User, columns, rows
+
+    def generate_recipes(self, rng, start, stop):
+        count = stop - start
+        authors = self.popular(rng, self.users, count, 'authors')
+        dishes = rng.integers(len(DISHES), size=count)
+        fillings = rng.integers(len(FILLINGS), size=count)
+        steps = rng.integers(len(STEPS), size=(count, 3))
+        cooking_times = rng.integers(5, 181, size=count)
+        dates = self.recipe_dates(range(start, stop))
+        columns = (
+            'id', 'author_id', 'name', 'image', 'text', 'cooking_time',
+            'pub_date', 'updated_at',
+        )
+        rows = (
+            (
+                self.first_recipe + start + offset,
+                self.first_user + int(authors[offset]),
+                f'{DISHES[dishes[offset]]} {FILLINGS[fillings[offset]]}',
+                f'recipe_images/{self.prefix}.png',
+                ' '.join(STEPS[step] for step in steps[offset]),
+                int(cooking_times[offset]),
+                dates[offset],
+                dates[offset],
+            )
+            for offset in range(count)
+        )
+        return Recipe, columns, rows
+
+    def generate_recipe_ingredients(self, rng, start, stop):
+        size = len(self.ingredient_ids)
+        counts = rng.integers(3, 16, size=stop - start)
+        recipes = np.repeat(np.arange(start, stop), np.minimum(counts, size))
+        ingredients = self.popular(rng, size, len(recipes), 'ingredients')
+        keys = np.unique(recipes * size + ingredients)
+        amounts = rng.integers(1, 501, size=len(keys))
+        rows = (
+            (
+                self.first_recipe + int(key // size),
+                int(self.ingredient_ids[key % size]),
+                int(amount),
+            )
+            for key, amount in zip(keys, amounts)
+        )
+        columns = ('recipe_id', 'ingredient_id', 'amount')
+        return RecipesIngredients, columns, rows
+
+    def generate_recipe_tags(self, rng, start, stop):
+        size = len(self.tag_ids)
+        counts = rng.integers(1, 4, size=stop - start)
+        recipes = np.repeat(np.arange(start, stop), np.minimum(counts, size))
+        tags = self.popular(rng, size, len(recipes), 'tags')
+        keys = np.unique(recipes * size + tags)
+        rows = (
+            (self.first_recipe + int(key // size),
+             int(self.tag_ids[key % size]))
+            for key in keys
+        )
+        return Recipe.tags.through, ('recipe_id', 'tag_id'), rows
+
+    def generate_subscriptions(self, rng, start, stop):
+        users, authors = self.pairs(
+            rng, 'subscriptions', start, stop, self.users, 'authors'
+        )
+        rows = (
+            (self.first_user + int(user), self.first_user + int(author))
+            for user, author in zip(users, authors)
+        )
+        return Subscribe, ('user_id', 'author_id'), rows
+
+    def generate_favorites(self, rng, start, stop, table='favorites',
+                           model=Favorite):
+        users, recipes = self.pairs(
+            rng, table, start, stop, self.recipes, 'recipes'
+        )
+        published = self.recipe_dates(recipes)
+        delays = rng.random(len(recipes))
+        rows = (
+            (
+                self.first_user + int(user),
+                self.first_recipe + int(recipe),
+                date + (self.until - date) * float(delay),
+            )
+            for user, recipe, date, delay in zip(
+                users, recipes, published, delays
+            )
+        )
+        return model, ('user_id', 'recipe_id', 'pub_date'), rows
+
+    def generate_cart(self, rng, start, stop):
+        return self.generate_favorites(rng, start, stop, 'cart', ShoppingCart)
+
+
+def write_chunk(plan, table, start):
+    write_rows(*plan.generate(table, start))
+    return table, start
+
+
+class Seeder:
+    """Генератор правдоподобных данных Foodgram заданного масштаба.
+
+    Популярность авторов, рецептов и ингредиентов и активность
+    пользователей распределены по Ципфу. Пользователи и рецепты получают
+    id подряд после уже существующих, связи ссылаются на них напрямую.
+    Строки пишутся потоками без сигналов, а счётчики, итоги списков
+    покупок, поисковые векторы и ленты пересчитываются в конце.
+    """
+
+    def __init__(self, prefix, seed=0, stdout=None):
+        self.prefix = prefix
+        self.seed_value = seed
+        self.stdout = stdout
+
+    def log(self, message):
+        if self.stdout is not None:
+            self.stdout.write(message)
+
+    def seed(self, users, recipes, subscriptions=None, favorites=None,
+             cart=None, tags=10, ingredients=500, workers=1, feed=True,
+             skew=1.1):
+        if workers > 1 and connection.vendor != 'postgresql':
+            raise RuntimeError(
+                'Параллельная запись поддерживается только в PostgreSQL.'
+            )
+        if workers > 1 and connection.in_atomic_block:
+            raise RuntimeError(
+                'Параллельная запись невозможна внутри транзакции.'
+            )
+        plan = SeedPlan(
+            self.prefix, self.seed_value, users, recipes,
+            users * 20 if subscriptions is None else subscriptions,
+            users * 20 if favorites is None else favorites,
+            users * 5 if cart is None else cart,
+            skew=skew,
+        )
+        self.tags = self.ensure_tags(tags)
+        self.ingredient_ids = self.ensure_ingredients(ingredients)
+        first_user = self.next_id(User)
+        first_recipe = self.next_id(Recipe)
+        plan.bind(
+            first_user, first_recipe,
+            [tag.pk for tag in self.tags], self.ingredient_ids,
+        )
+        self.user_ids = range(first_user, first_user + users)
+        self.recipe_ids = range(first_recipe, first_recipe + recipes)
+
+        phases = (
+            ('users',),
+            ('recipes',),
+            ('recipe_ingredients', 'recipe_tags', 'subscriptions',
+             'favorites', 'cart'),
+        )
+        if workers > 1:
+            with ProcessPoolExecutor(
+                max_workers=workers, mp_context=get_context('spawn'),
+                # Ссылка на сам django.setup: модуль с моделями нельзя
+                # импортировать в процессе до настройки Django.
+                initializer=django.setup,
+            ) as executor:
+                for tables in phases:
+                    self.run_phase(tables, plan, executor)
+        else:
+            for tables in phases:
+                self.run_phase(tables, plan)
+        self.reset_sequences()
+        self.refresh_derived(feed)
+        return self
+
+    def run_phase(self, tables, plan, executor=None):
+        tasks = [
+            (table, start) for table in tables for start in plan.chunks(table)
+        ]
+        if executor is None:
+            for table, start in tasks:
+                with transaction.atomic():
+                    write_chunk(plan, table, start)
+        else:
+            futures = [
+                executor.submit(write_chunk, plan, table, start)
+                for table, start in tasks
+            ]
+            for future in futures:
+                future.result()
+        self.log(f'Записано: {", ".join(tables)}.')
+
+    def next_id(self, model):
+        last = model.objects.order_by('-pk').values_list(
+            'pk', flat=True
+        ).first()
+        return (last or 0) + 1
+
+    def reset_sequences(self):
+        """После явных id счётчики автоинкремента надо подвинуть."""
+        statements = connection.ops.sequence_reset_sql(
+            no_style(), [User, Recipe]
+        )
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
+
+    def ensure_tags(self, count):
+        """Теги префикса; цвет уникален и среди тегов других префиксов.
+
+        Цвет выводится из slug, занятые цвета пропускаются. Если цвет
+        успели занять параллельно, подбор повторяется.
+        """
+        slugs = [f'{self.prefix}-{number}' for number in range(count)]
+        for _ in range(TAG_COLOR_ATTEMPTS):
+            existing = set(Tag.objects.filter(slug__in=slugs).values_list(
+                'slug', flat=True
+            ))
+            taken = set(Tag.objects.values_list('color', flat=True))
+            tags = []
+            for number, slug in enumerate(slugs):
+                if slug in existing:
+                    continue
+                attempt = 0
+                while tag_color(slug, attempt) in taken:
+                    attempt += 1
+                taken.add(tag_color(slug, attempt))
+                tags.append(Tag(
+                    name=f'{self.prefix} тег {number}',
+                    color=tag_color(slug, attempt),
+                    slug=slug,
+                ))
+            try:
+                with transaction.atomic():
+                    Tag.objects.bulk_create(tags)
+                break
+            except IntegrityError:
+                continue
+        else:
+            raise RuntimeError('Не удалось подобрать уникальные цвета тегов.')
+        return list(Tag.objects.filter(slug__in=slugs))
+
+    def ensure_ingredients(self, count):
+        """Ингредиенты из справочника, при нехватке — сгенерированные."""
+        existing = list(Ingredient.objects.exclude(
+            name__startswith=self.prefix
+        ).order_by('pk').values_list('pk', flat=True)[:count])
+        names = [
+            f'{self.prefix} ингредиент {number}'
+            for number in range(count - len(existing))
+        ]
+        created = set(Ingredient.objects.filter(name__in=names).values_list(
+            'name', flat=True
+        ))
+        Ingredient.objects.bulk_create(
+            (
+                Ingredient(
+                    name=name,
+                    measurement_unit=UNITS[number % len(UNITS)],
+                    search_name=fold_search_name(name),
+                )
+                for number, name in enumerate(names) if name not in created
+            ),
+            batch_size=BATCH_SIZE,
+        )
+        return existing + list(Ingredient.objects.filter(
+            name__in=names
+        ).order_by('pk').values_list('pk', flat=True))
+
+    def refresh_derived(self, feed=True):
+        """Пересчитывает то, что при обычной записи обновляют сигналы."""
+        call_command('reconcile_counters', stdout=StringIO())
+        call_command('rebuild_cart_totals', stdout=StringIO())
+        for start in range(0, len(self.recipe_ids), BATCH_SIZE):
+            batch = self.recipe_ids[start:start + BATCH_SIZE]
+            Recipe.objects.filter(
+                pk__gte=batch.start, pk__lt=batch.stop
+            ).update_search_vector()
+        if feed:
+            FeedEntry.objects.backfill()
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+        bump_version(RECIPES, REFERENCE, FAVORITES)
+        self.log('Счётчики, поисковые векторы и ленты пересчитаны.')
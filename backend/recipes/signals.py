@@ -0,0 +1,355 @@
+import threading
+from functools import partial
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete,
+    pre_save
+)
+from django.dispatch import receiver
+from django.utils import timezone
+
+from users.models import Subscribe, User
+
+from .images import needs_renditions, renditions_ready, schedule_renditions
+from .models import (
+    Favorite,
+    FeedEntry,
+    Ingredient,
+    Recipe,
+    RecipesIngredients,
+    ShoppingCart,
+    ShoppingCartTotal,
+    Tag,
+    ingredients_changed,
+    recipes_added,
+    recipes_removed
+)
+from .versions import (
+    DELETED_RECIPES,
+    FAVORITES,
+    RECIPES,
+    REFERENCE,
+    bump_version_on_commit
+)
+
+PROFILE_FIELDS = frozenset(
+    ('username', 'email', 'first_name', 'last_name', 'avatar')
+)
+IMAGE_FIELDS = {Recipe: 'image', User: 'avatar'}
+
+# Рецепты, которые удаляются в этом потоке. Их вклад в итоги списков
+# покупок целиком вычитает shopping_cart_removed, поэтому удаление строк
+# состава каскадом итоги не трогает.
+_deleting = threading.local()
+
+
+def deleting_recipes():
+    if not hasattr(_deleting, 'recipe_ids'):
+        _deleting.recipe_ids = set()
+    return _deleting.recipe_ids
+
+
+def decrement(field):
+    """Уменьшает счётчик, не опуская его ниже нуля.
+
+    Счётчик мог разойтись с данными (например, после заливки COPY), и
+    нарушение CHECK не должно срывать отписку или удаление из избранного.
+    """
+    return Greatest(F(field) - 1, 0)
+
+
+def bump_user_versions(users, *fields):
+    """Увеличивает счётчики версий у выбранных пользователей."""
+    users.update(**{field: F(field) + 1 for field in fields})
+
+
+@receiver([post_save, post_delete], sender=ShoppingCart)
+def shopping_cart_changed(sender, instance, **kwargs):
+    bump_user_versions(
+        User.objects.filter(pk=instance.user_id),
+        'cart_version', 'relations_version',
+    )
+
+
+@receiver([post_save, post_delete], sender=Favorite)
+@receiver([post_save, post_delete], sender=Subscribe)
+def relations_changed(sender, instance, **kwargs):
+    bump_user_versions(
+        User.objects.filter(pk=instance.user_id), 'relations_version'
+    )
+
+
+@receiver([recipes_added, recipes_removed], sender=ShoppingCart)
+def shopping_cart_recipes_changed(sender, user_id, **kwargs):
+    bump_user_versions(
+        User.objects.filter(pk=user_id), 'cart_version', 'relations_version'
+    )
+
+
+@receiver([recipes_added, recipes_removed], sender=Favorite)
+def favorite_recipes_changed(sender, user_id, **kwargs):
+    bump_user_versions(User.objects.filter(pk=user_id), 'relations_version')
+
+
+@receiver(post_save, sender=Favorite)
+def favorite_added(sender, instance, created, **kwargs):
+    if created:
+        Recipe.objects.filter(pk=instance.recipe_id).update(
+            favorites_count=F('favorites_count') + 1
+        )
+        bump_version_on_commit(FAVORITES)
+
+
+@receiver(post_delete, sender=Favorite)
+def favorite_removed(sender, instance, **kwargs):
+    Recipe.objects.filter(pk=instance.recipe_id).update(
+        favorites_count=decrement('favorites_count')
+    )
+    bump_version_on_commit(FAVORITES)
+
+
+@receiver(recipes_added, sender=Favorite)
+def favorites_added(sender, recipe_ids, **kwargs):
+    Recipe.objects.filter(pk__in=recipe_ids).update(
+        favorites_count=F('favorites_count') + 1
+    )
+    bump_version_on_commit(FAVORITES)
+
+
+@receiver(recipes_removed, sender=Favorite)
+def favorites_removed(sender, recipe_ids, **kwargs):
+    Recipe.objects.filter(pk__in=recipe_ids).update(
+        favorites_count=decrement('favorites_count')
+    )
+    bump_version_on_commit(FAVORITES)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_created(sender, instance, created, **kwargs):
+    if created and instance.author_id:
+        User.objects.filter(pk=instance.author_id).update(
+            recipes_count=F('recipes_count') + 1
+        )
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted(sender, instance, **kwargs):
+    if instance.author_id:
+        User.objects.filter(pk=instance.author_id).update(
+            recipes_count=decrement('recipes_count')
+        )
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_published(sender, instance, created, **kwargs):
+    if created and instance.author_id:
+        transaction.on_commit(
+            partial(FeedEntry.objects.fan_out, [instance.pk])
+        )
+
+
+@receiver(post_save, sender=Subscribe)
+def subscribed(sender, instance, created, **kwargs):
+    if created:
+        User.objects.filter(pk=instance.author_id).update(
+            followers_count=F('followers_count') + 1
+        )
+        FeedEntry.objects.fan_out_recent(
+            instance.author_id, user_id=instance.user_id
+        )
+
+
+@receiver(post_delete, sender=Subscribe)
+def unsubscribed(sender, instance, **kwargs):
+    User.objects.filter(pk=instance.author_id).update(
+        followers_count=decrement('followers_count')
+    )
+    FeedEntry.objects.filter(
+        user_id=instance.user_id, author_id=instance.author_id
+    ).delete()
+    if User.objects.filter(
+        pk=instance.author_id, followers_count=settings.FEED_FANOUT_LIMIT
+    ).exists():
+        # Автор снова раскладывает рецепты по лентам: недавние рецепты,
+        # которые подмешивались при чтении, добавляем подписчикам.
+        FeedEntry.objects.fan_out_recent(instance.author_id)
+
+
+@receiver(post_save, sender=ShoppingCart)
+def shopping_cart_added(sender, instance, created, **kwargs):
+    if created:
+        ShoppingCartTotal.objects.apply_recipe(
+            instance.recipe_id, 1, user_id=instance.user_id
+        )
+
+
+@receiver(pre_delete, sender=ShoppingCart)
+def shopping_cart_removed(sender, instance, **kwargs):
+    # pre_delete: при каскадном удалении рецепта его ингредиенты ещё
+    # на месте, и вклад рецепта можно вычесть.
+    ShoppingCartTotal.objects.apply_recipe(
+        instance.recipe_id, -1, user_id=instance.user_id
+    )
+
+
+def touch_recipe_ingredients(recipe_id):
+    Recipe.objects.filter(pk=recipe_id).update(updated_at=timezone.now())
+    bump_version_on_commit(RECIPES)
+    bump_user_versions(
+        User.objects.filter(shopping_cart__recipe=recipe_id),
+        'cart_version',
+    )
+
+
+@receiver(recipes_added, sender=ShoppingCart)
+def shopping_cart_recipes_added(sender, user_id, recipe_ids, **kwargs):
+    ShoppingCartTotal.objects.apply_user_recipes(user_id, recipe_ids, 1)
+
+
+@receiver(recipes_removed, sender=ShoppingCart)
+def shopping_cart_recipes_removed(sender, user_id, recipe_ids, **kwargs):
+    ShoppingCartTotal.objects.apply_user_recipes(user_id, recipe_ids, -1)
+
+
+@receiver(pre_delete, sender=Recipe)
+def recipe_deleting(sender, instance, **kwargs):
+    deleting_recipes().add(instance.pk)
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted_from_carts(sender, instance, **kwargs):
+    deleting_recipes().discard(instance.pk)
+
+
+@receiver(pre_save, sender=RecipesIngredients)
+def recipe_ingredient_saving(sender, instance, **kwargs):
+    """Запоминает прежнюю строку, чтобы применить к итогам разницу."""
+    instance._previous = None
+    if not instance._state.adding:
+        instance._previous = RecipesIngredients.objects.filter(
+            pk=instance.pk
+        ).values_list('recipe_id', 'ingredient_id', 'amount').first()
+
+
+@receiver(post_save, sender=RecipesIngredients)
+def recipe_ingredient_saved(sender, instance, **kwargs):
+    """Правка строки состава в обход sync(): админка, shell."""
+    changes = {(instance.recipe_id, instance.ingredient_id): instance.amount}
+    previous = getattr(instance, '_previous', None)
+    if previous is not None:
+        recipe_id, ingredient_id, amount = previous
+        key = (recipe_id, ingredient_id)
+        changes[key] = changes.get(key, 0) - amount
+    for (recipe_id, ingredient_id), amount in changes.items():
+        if amount:
+            ShoppingCartTotal.objects.apply_ingredient(
+                recipe_id, ingredient_id, amount
+            )
+
+
+@receiver(post_delete, sender=RecipesIngredients)
+def recipe_ingredient_deleted(sender, instance, **kwargs):
+    if instance.recipe_id not in deleting_recipes():
+        ShoppingCartTotal.objects.apply_ingredient(
+            instance.recipe_id, instance.ingredient_id, -instance.amount
+        )
+
+
+@receiver([post_save, post_delete], sender=RecipesIngredients)
+def recipe_ingredients_changed(sender, instance, **kwargs):
+    touch_recipe_ingredients(instance.recipe_id)
+
+
+@receiver([post_save, post_delete], sender=Recipe)
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def recipe_changed(sender, **kwargs):
+    bump_version_on_commit(RECIPES)
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_removed_from_index(sender, **kwargs):
+    """Индексы покрытия в процессах убирают удалённые рецепты."""
+    bump_version_on_commit(DELETED_RECIPES)
+
+
+@receiver([post_save, post_delete], sender=Tag)
+def tag_changed(sender, **kwargs):
+    bump_version_on_commit(REFERENCE)
+
+
+@receiver(post_delete, sender=Ingredient)
+@receiver(post_save, sender=Ingredient)
+def ingredient_changed(sender, instance, created=False, **kwargs):
+    bump_version_on_commit(REFERENCE)
+    if not created:
+        bump_user_versions(
+            User.objects.filter(shopping_cart__recipe__ingredients=instance),
+            'cart_version',
+        )
+
+
+@receiver(post_save, sender=User)
+def profile_changed(sender, instance, created, update_fields, **kwargs):
+    """Данные автора входят в рецепты: обновляем их отметки времени."""
+    if created or (update_fields and not PROFILE_FIELDS & update_fields):
+        return
+    Recipe.objects.filter(author=instance).update(updated_at=timezone.now())
+    bump_version_on_commit(RECIPES)
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_save, sender=User)
+def image_saved(sender, instance, **kwargs):
+    field_name = IMAGE_FIELDS[sender]
+    if needs_renditions(instance, field_name):
+        schedule_renditions(instance, field_name)
+
+
+@receiver(renditions_ready, sender=Recipe)
+def recipe_renditions_ready(sender, pk, **kwargs):
+    Recipe.objects.filter(pk=pk).update(updated_at=timezone.now())
+    bump_version_on_commit(RECIPES)
+
+
+@receiver(renditions_ready, sender=User)
+def avatar_renditions_ready(sender, pk, **kwargs):
+    Recipe.objects.filter(author_id=pk).update(updated_at=timezone.now())
+    bump_version_on_commit(RECIPES)
+
+
+def update_search_vector(recipes):
+    """Пересчитывает поисковый вектор после фиксации транзакции.
+
+    К этому времени на месте и рецепт, и все его ингредиенты.
+    """
+    transaction.on_commit(recipes.update_search_vector)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_saved(sender, instance, **kwargs):
+    update_search_vector(Recipe.objects.filter(pk=instance.pk))
+
+
+@receiver([post_save, post_delete], sender=RecipesIngredients)
+def recipe_ingredients_saved(sender, instance, **kwargs):
+    update_search_vector(Recipe.objects.filter(pk=instance.recipe_id))
+
+
+@receiver(ingredients_changed, sender=RecipesIngredients)
+def recipe_ingredients_synced(sender, recipe_id, **kwargs):
+    """Состав рецепта изменён через RecipesIngredients.objects.sync()."""
+    touch_recipe_ingredients(recipe_id)
+    update_search_vector(Recipe.objects.filter(pk=recipe_id))
+
+
+@receiver(post_save, sender=Ingredient)
+def ingredient_renamed(sender, instance, created, **kwargs):
+    if not created:
+        update_search_vector(Recipe.objects.filter(ingredients=instance))
@@ -0,0 +1,43 @@
+import time
+from functools import partial
+
+from django.core.cache import cache
+from django.db import transaction
+
+DELETED_RECIPES = 'deleted_recipes'
+FAVORITES = 'favorites'
+RECIPES = 'recipes'
+REFERENCE = 'reference'
+
+
+def _key(name):
+    return f'version:{name}'
+
+
+def get_version(name):
+    """Текущая версия группы данных из общего кэша.
+
+    Версия — отметка времени последнего изменения. Если ключ пропал из
+    кэша, создаётся новая версия, поэтому старые ETag не совпадут.
+    """
+    version = cache.get(_key(name))
+    if version is None:
+        cache.add(_key(name), time.time_ns(), timeout=None)
+        version = cache.get(_key(name))
+    return version
+
+
+def bump_version(*names):
+    """Помечает группы данных как изменившиеся."""
+    cache.set_many(
+        {_key(name): time.time_ns() for name in names}, timeout=None
+    )
+
+
+def bump_version_on_commit(*names):
+    """Помечает группы данных как изменившиеся после фиксации транзакции.
+
+    Иначе читатель может получить новую версию раньше, чем увидит сами
+    изменения, и запомнить под ней старые данные.
+    """
+    transaction.on_commit(partial(bump_version, *names))
@@ -6,4 +6,4 @@ done;
 
 python manage.py migrate;
 python manage.py collectstatic --noinput;
-gunicorn -w 2 -b 0:8008 foodgram.wsgi;
+gunicorn -c gunicorn.conf.py;
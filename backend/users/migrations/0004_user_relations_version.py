@@ -0,0 +1,18 @@
+# Generated by Django 3.2.3 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_subscribe_user_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='relations_version',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Версия подписок, избранного и списка покупок'),
+        ),
+    ]
@@ -40,6 +40,31 @@ class User(AbstractUser):
         null=True,
         verbose_name='Аватар',
     )
+    avatar_renditions = models.JSONField(
+        'Уменьшенные копии аватара',
+        default=dict,
+        editable=False,
+    )
+    recipes_count = models.PositiveIntegerField(
+        'Количество рецептов',
+        default=0,
+        editable=False,
+    )
+    followers_count = models.PositiveIntegerField(
+        'Количество подписчиков',
+        default=0,
+        editable=False,
+    )
+    cart_version = models.PositiveIntegerField(
+        'Версия списка покупок',
+        default=0,
+        editable=False,
+    )
+    relations_version = models.PositiveIntegerField(
+        'Версия подписок, избранного и списка покупок',
+        default=0,
+        editable=False,
+    )
 
     class Meta:
         verbose_name = 'пользователь'
@@ -76,6 +101,12 @@ class Subscribe(models.Model):
                 name='unique_follow',
             )
         ]
+        indexes = [
+            models.Index(
+                fields=['user', '-id'],
+                name='subscribe_user_id_idx',
+            ),
+        ]
 
     def __str__(self):
         return f'{self.user} подписан на {self.author}'